@@ -0,0 +1,58 @@
+"""Compare memory per stored chat turn: plain dicts vs MessageRecord.
+
+Usage: python bench_message_memory.py [count]
+"""
+import os
+import sys
+import tracemalloc
+from datetime import datetime
+
+os.environ.setdefault("DATABASE_URL", "")
+
+from server import MessageRecord, epoch_ms, estimate_tokens
+
+
+def make_dicts(count: int):
+    now = datetime.now()
+    entries = []
+    for i in range(count):
+        content = f"message {i}"
+        entry = {
+            "id": i,
+            "role": "user" if i % 2 == 0 else "assistant",
+            "content": content,
+            "timestamp": now.isoformat(),
+            "tokens": estimate_tokens(content)
+        }
+        if i % 2:
+            entry["model"] = "gpt-4o"
+            entry["provider"] = "openai"
+        entries.append(entry)
+    return entries
+
+
+def make_records(count: int):
+    now = epoch_ms()
+    return [
+        MessageRecord(i, "user" if i % 2 == 0 else "assistant", f"message {i}", now,
+                      model="gpt-4o" if i % 2 else None, provider="openai" if i % 2 else None)
+        for i in range(count)
+    ]
+
+
+def measure(factory, count: int) -> float:
+    tracemalloc.start()
+    entries = factory(count)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del entries
+    return size / count
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    dict_size = measure(make_dicts, count)
+    record_size = measure(make_records, count)
+    print(f"{count} messages")
+    print(f"dict entries:    {dict_size:8.1f} bytes/message")
+    print(f"MessageRecord:   {record_size:8.1f} bytes/message ({100 * (1 - record_size / dict_size):.0f}% smaller)")
@@ -1,18 +1,38 @@
 import os
 import json
 import asyncio
+import bisect
+import codecs
+import contextvars
 import logging
+import mimetypes
+import mmap
 import subprocess
 import tempfile
 import shutil
+import sys
+import time
+import hashlib
+import heapq
+import math
+import threading
+import sqlite3
+import random
+import re
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from email.utils import formatdate
+from stat import S_ISREG
 from pathlib import Path
-from typing import Dict, List, Optional, Any
+from typing import AsyncIterator, Dict, List, Optional, Any
 import uuid
+from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect, UploadFile, File
+from fastapi import FastAPI, HTTPException, Query, Request, Response, WebSocket, WebSocketDisconnect, UploadFile, File
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
 import uvicorn
 from dotenv import load_dotenv
@@ -26,9 +46,15 @@ except ImportError:
 
 try:
     import google.generativeai as genai
+    from google.ai import generativelanguage as glm
 except ImportError:
     genai = None
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 # Load environment variables
 load_dotenv()
 
@@ -36,7 +62,25 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="AI Engineer Backend", version="2.0.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Application startup/shutdown hooks"""
+    global summary_queue
+    summary_queue = asyncio.Queue()
+    await conversation_store.start()
+    workers = [
+        asyncio.create_task(summarization_worker()),
+        asyncio.create_task(session_registry.sweep_forever())
+    ]
+    yield
+    for worker in workers:
+        worker.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+    await conversation_store.stop()
+    await close_provider_clients()
+    shutdown_io()
+
+app = FastAPI(title="AI Engineer Backend", version="2.0.0", lifespan=lifespan)
 
 # CORS middleware
 app.add_middleware(
@@ -49,7 +93,6 @@ app.add_middleware(
 
 # Global state
 active_sessions = {}
-conversation_history = {}
 api_keys = {
     "openai": os.getenv("OPENAI_API_KEY"),
     "anthropic": os.getenv("ANTHROPIC_API_KEY"),
@@ -63,9 +106,24 @@ class ChatMessage(BaseModel):
     model: str = "gpt-4o"
     provider: str = "openai"
     session_id: str
-    context: Optional[Dict] = None
+    context: Optional[Dict] = None  # Replaces the session's stored context
+    context_delta: Optional[Dict] = None  # JSON merge patch applied to the stored context
+    context_version: Optional[int] = None  # Version context_delta was built against (409 on mismatch)
     temperature: float = 0.7
     max_tokens: int = 2000
+    cache: Optional[bool] = None  # None = only cache deterministic (temperature 0) requests
+    semantic_cache: Optional[bool] = None  # None = use SEMANTIC_CACHE_ENABLED
+    hedge: Optional[bool] = None  # None = use HEDGE_ENABLED
+    project_root: Optional[str] = None  # Remembered per session for context packing
+    context_budget: Optional[int] = None  # Tokens of project snippets; None = CONTEXT_TOKEN_BUDGET
+
+class ContextUpdate(BaseModel):
+    context: Optional[Dict] = None
+    delta: Optional[Dict] = None
+    version: Optional[int] = None
+
+class BatchChatRequest(BaseModel):
+    items: List[ChatMessage]
 
 class FileOperation(BaseModel):
     operation: str  # read, write, create, delete, list
@@ -73,6 +131,10 @@ class FileOperation(BaseModel):
     content: Optional[str] = None
     recursive: bool = False
 
+class FileOperationBatch(BaseModel):
+    operations: List[FileOperation]
+    atomic: bool = False  # All-or-nothing; only write, create and delete
+
 class CommandExecution(BaseModel):
     command: str
     session_id: str
@@ -97,6 +159,16 @@ class CodeGeneration(BaseModel):
     language: str = "python"
     framework: Optional[str] = None
     style: str = "clean"  # clean, minimal, verbose
+    cache: Optional[bool] = None
+    semantic_cache: Optional[bool] = None
+
+class UploadInit(BaseModel):
+    path: str  # Destination, including the file name
+    size: int
+    sha256: Optional[str] = None
+
+class UploadFinalize(BaseModel):
+    sha256: Optional[str] = None  # Required here if not given at init
 
 # AI Provider configurations
 MODELS = {
@@ -162,6 +234,7 @@ async def add_api_key(request: APIKeyRequest):
     """Add or update API key"""
     try:
         api_keys[request.provider] = request.api_key
+        await close_provider_clients(request.provider)
         logger.info(f"API key updated for provider: {request.provider}")
         return {"success": True, "message": f"API key for {request.provider} updated successfully"}
     except Exception as e:
@@ -173,6 +246,7 @@ async def delete_api_key(provider: str):
     """Delete API key"""
     if provider in api_keys:
         api_keys[provider] = None
+        await close_provider_clients(provider)
         return {"success": True, "message": f"API key for {provider} deleted"}
     else:
         raise HTTPException(status_code=404, detail="Provider not found")
@@ -187,7 +261,9 @@ async def test_api_key(request: TestAPIKeyRequest):
                 request.test_message, 
                 request.model, 
                 request.provider,
-                temperature=0.7
+                temperature=0.7,
+                use_cache=False,
+                semantic_cache_enabled=False
             )
             return {
                 "success": True,
@@ -200,7 +276,9 @@ async def test_api_key(request: TestAPIKeyRequest):
                 request.test_message, 
                 request.model, 
                 request.provider,
-                temperature=0.7
+                temperature=0.7,
+                use_cache=False,
+                semantic_cache_enabled=False
             )
             return {
                 "success": True,
@@ -214,74 +292,2247 @@ async def test_api_key(request: TestAPIKeyRequest):
             "message": f"API key test failed: {str(e)}"
         }
 
-async def chat_with_ai(message: str, model: str, provider: str, temperature: float = 0.7, max_tokens: int = 2000) -> str:
-    """Chat with AI providers"""
+# Provider client pool - one long-lived async client per (provider, api_key).
+# The SDK clients keep their own pooled HTTP connections, so reusing them
+# avoids a TLS handshake per request. Requests lease a client; one replaced
+# by a key change is closed when its last lease ends.
+PROVIDER_TIMEOUT = float(os.getenv("PROVIDER_TIMEOUT", 120))
+provider_clients: Dict[tuple, Any] = {}
+client_leases: Dict[int, int] = {}  # id(client) -> requests or streams using it
+retired_clients: Dict[int, tuple] = {}  # id(client) -> (pool key, client) awaiting its last lease
+
+def get_provider_client(provider: str, api_key: str):
+    """Get or create the pooled async client for a provider/key pair"""
+    key = (provider, api_key)
+    client = provider_clients.get(key)
+    if client is None:
+        if provider == "openai":
+            client = openai.AsyncOpenAI(api_key=api_key, timeout=PROVIDER_TIMEOUT, max_retries=0)
+        elif provider == "anthropic" and anthropic:
+            client = anthropic.AsyncAnthropic(api_key=api_key, timeout=PROVIDER_TIMEOUT, max_retries=0)
+        elif provider == "gemini" and genai:
+            # Own client instead of genai.configure(), which is process-global and
+            # drops the SDK's cached clients (and their channels) on every call
+            client = glm.GenerativeServiceAsyncClient(client_options={"api_key": api_key})
+        else:
+            raise Exception(f"Provider {provider} has no pooled client")
+        provider_clients[key] = client
+    return client
+
+@asynccontextmanager
+async def leased_client(provider: str, api_key: str):
+    """Pooled client held for the length of one request or stream"""
+    client = get_provider_client(provider, api_key)
+    client_leases[id(client)] = client_leases.get(id(client), 0) + 1
+    try:
+        yield client
+    finally:
+        client_leases[id(client)] -= 1
+        if not client_leases[id(client)]:
+            del client_leases[id(client)]
+            retired = retired_clients.pop(id(client), None)
+            if retired:
+                await close_client(*retired)
+
+def gemini_model(client, model: str, system: Optional[str]):
+    """GenerativeModel that sends through a pooled client rather than the SDK's global one"""
+    model_instance = genai.GenerativeModel(model, system_instruction=system) if system else genai.GenerativeModel(model)
+    model_instance._async_client = client  # Slot the SDK otherwise fills from its global default
+    return model_instance
+
+async def close_client(key: tuple, client):
     try:
-        if provider == "openai" or provider == "emergent":
+        if hasattr(client, "close"):
+            await client.close()
+        else:
+            await client.transport.close()  # Gemini's GAPIC client
+    except Exception as e:
+        logger.warning(f"Error closing {key[0]} client: {str(e)}")
+
+async def close_provider_clients(provider: Optional[str] = None):
+    """Drop pooled clients (optionally one provider's); ones still in use close after their last request"""
+    for key in list(provider_clients):
+        if provider is None or key[0] == provider:
+            client = provider_clients.pop(key)
+            if provider is not None and id(client) in client_leases:
+                retired_clients[id(client)] = (key, client)
+            else:
+                await close_client(key, client)
+    if provider is None:
+        for key, client in list(retired_clients.values()):
+            await close_client(key, client)
+        retired_clients.clear()
+
+class ResponseCache:
+    """Exact-match LRU cache of AI responses bounded by memory and TTL"""
+
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (response, expires_at, size)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(provider: str, model: str, messages: List[Dict], temperature: float, max_tokens: int) -> str:
+        normalized = [[m["role"], " ".join(m["content"].split())] for m in messages]
+        raw = json.dumps([provider, model, normalized, temperature, max_tokens])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def should_cache(temperature: float, use_cache: Optional[bool]) -> bool:
+        if use_cache is None:
+            return temperature <= 0
+        return use_cache
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        response, expires_at, size = entry
+        if expires_at < time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return response
+
+    def put(self, key: str, response: str):
+        size = sys.getsizeof(key) + sys.getsizeof(response)
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (response, time.monotonic() + self.ttl, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def _remove(self, key: str):
+        self.size -= self.entries.pop(key)[2]
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+response_cache = ResponseCache(
+    max_bytes=int(os.getenv("RESPONSE_CACHE_MAX_BYTES", 64 * 1024 * 1024)),
+    ttl=float(os.getenv("RESPONSE_CACHE_TTL", 3600))
+)
+
+# Semantic cache - paraphrased prompts answered from a local index. Prompts are
+# embedded with a hashing vectorizer (no model download) and kept in one
+# contiguous NumPy matrix per provider/model; lookups are a single mat-vec
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.8))
+SEMANTIC_CACHE_DIM = int(os.getenv("SEMANTIC_CACHE_DIM", 2048))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", 5000))  # Per provider/model
+SEMANTIC_CACHE_TOP_K = int(os.getenv("SEMANTIC_CACHE_TOP_K", 5))
+SEMANTIC_CACHE_TTL = float(os.getenv("SEMANTIC_CACHE_TTL", 3600))
+SEMANTIC_STOPWORDS = frozenset(
+    "a an the to of for in on and or with that this is are be please can could would you me my i "
+    "how do does what write create make generate give show implement using use".split()
+)
+
+SEMANTIC_ALIASES = {
+    "fn": "function", "func": "function", "def": "function", "method": "function",
+    "str": "string", "int": "integer", "dict": "dictionary", "arr": "array",
+    "py": "python", "js": "javascript", "ts": "typescript"
+}
+
+def semantic_stem(word: str) -> str:
+    """Alias expansion plus crude suffix stripping so 'reversing'/'reverses' share a feature with 'reverse'"""
+    word = SEMANTIC_ALIASES.get(word, word)
+    for suffix in ("ing", "ed", "es", "s", "e"):
+        if len(word) > len(suffix) + 2 and word.endswith(suffix):
+            return word[:-len(suffix)]
+    return word
+
+class SemanticIndex:
+    """Embedding matrix for one provider/model; rows are reused least-recently-used first"""
+
+    def __init__(self, dim: int, capacity: int):
+        self.capacity = capacity
+        self.vectors = np.zeros((min(capacity, 64), dim), dtype=np.float32)
+        self.expires = np.zeros(len(self.vectors))
+        self.used = np.zeros(len(self.vectors), dtype=np.int64)
+        self.scopes: List[str] = []
+        self.responses: List[str] = []
+        self.response_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self.responses)
+
+    def nbytes(self) -> int:
+        return self.vectors.nbytes + self.expires.nbytes + self.used.nbytes + self.response_bytes
+
+    def search(self, vector, top_k: int) -> List[tuple]:
+        """Best (row, score) pairs among live rows, highest score first"""
+        count = len(self)
+        if count == 0:
+            return []
+        scores = self.vectors[:count] @ vector
+        scores[self.expires[:count] < time.monotonic()] = -1.0
+        k = min(top_k, count)
+        rows = np.argpartition(-scores, k - 1)[:k]
+        rows = rows[np.argsort(-scores[rows])]
+        return [(int(row), float(scores[row])) for row in rows]
+
+    def add(self, vector, scope: str, response: str, ttl: float, tick: int) -> bool:
+        """Store a row; returns True if a live entry had to be evicted"""
+        count = len(self)
+        evicted = False
+        if count < len(self.vectors):
+            row = count
+            self.scopes.append(scope)
+            self.responses.append(response)
+        elif count < self.capacity:
+            size = min(self.capacity, count * 2)
+            self.vectors = np.resize(self.vectors, (size, self.vectors.shape[1]))
+            self.expires = np.resize(self.expires, size)
+            self.used = np.resize(self.used, size)
+            row = count
+            self.scopes.append(scope)
+            self.responses.append(response)
+        else:
+            row = int(np.argmin(self.used[:count]))
+            evicted = self.expires[row] >= time.monotonic()
+            self.response_bytes -= sys.getsizeof(self.responses[row])
+            self.scopes[row] = scope
+            self.responses[row] = response
+        self.vectors[row] = vector
+        self.expires[row] = time.monotonic() + ttl
+        self.used[row] = tick
+        self.response_bytes += sys.getsizeof(response)
+        return evicted
+
+class SemanticCache:
+    """Similarity-threshold response cache keyed by provider/model and an exact scope"""
+
+    def __init__(self, threshold: float, dim: int, max_entries: int, top_k: int, ttl: float):
+        self.threshold = threshold
+        self.dim = dim
+        self.max_entries = max_entries
+        self.top_k = top_k
+        self.ttl = ttl
+        self.indexes: Dict[tuple, SemanticIndex] = {}
+        self.tick = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def available(self) -> bool:
+        return np is not None and self.max_entries > 0
+
+    def should_use(self, semantic_cache: Optional[bool]) -> bool:
+        enabled = SEMANTIC_CACHE_ENABLED if semantic_cache is None else semantic_cache
+        return enabled and self.available
+
+    def embed(self, text: str):
+        """Signed hashing of stemmed content words and their adjacent bigrams, L2-normalised"""
+        words = [semantic_stem(w) for w in re.findall(r"[a-z0-9]+", text.lower()) if w not in SEMANTIC_STOPWORDS]
+        if not words:
+            return None
+        # Bigrams are taken over content words only, so "int to str" yields "integer string"
+        # and "str to int" yields "string integer": same bag of words, no shared bigram. No
+        # character n-grams - they made short swapped prompts look near-identical
+        features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+        hashes = np.fromiter((zlib.crc32(f.encode("utf-8")) for f in features), dtype=np.uint32, count=len(features))
+        vector = np.zeros(self.dim, dtype=np.float32)
+        np.add.at(vector, hashes % self.dim, np.where(hashes & 0x80000000, -1.0, 1.0).astype(np.float32))
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
+
+    def get(self, provider: str, model: str, scope: str, text: str) -> Optional[str]:
+        index = self.indexes.get((provider, model))
+        vector = self.embed(text) if index is not None else None
+        if vector is not None:
+            for row, score in index.search(vector, self.top_k):
+                if score < self.threshold:
+                    break
+                if index.scopes[row] == scope:
+                    self.tick += 1
+                    index.used[row] = self.tick
+                    self.hits += 1
+                    return index.responses[row]
+        self.misses += 1
+        return None
+
+    def put(self, provider: str, model: str, scope: str, text: str, response: str):
+        vector = self.embed(text)
+        if vector is None:
+            return
+        index = self.indexes.get((provider, model))
+        if index is None:
+            index = self.indexes[(provider, model)] = SemanticIndex(self.dim, self.max_entries)
+        self.tick += 1
+        if index.add(vector, scope, response, self.ttl, self.tick):
+            self.evictions += 1
+
+    def clear(self):
+        self.indexes.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "available": self.available,
+            "enabled_by_default": SEMANTIC_CACHE_ENABLED,
+            "threshold": self.threshold,
+            "entries": {f"{provider}:{model}": len(index) for (provider, model), index in self.indexes.items()},
+            "bytes": sum(index.nbytes() for index in self.indexes.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+semantic_cache = SemanticCache(
+    threshold=SEMANTIC_CACHE_THRESHOLD,
+    dim=SEMANTIC_CACHE_DIM,
+    max_entries=SEMANTIC_CACHE_MAX_ENTRIES,
+    top_k=SEMANTIC_CACHE_TOP_K,
+    ttl=SEMANTIC_CACHE_TTL
+)
+if SEMANTIC_CACHE_ENABLED and np is None:
+    logger.warning("SEMANTIC_CACHE_ENABLED is set but numpy is not installed; semantic cache disabled")
+
+def semantic_scope(history: List[Dict], message: str, semantic_text: str, max_tokens: int, temperature: float) -> str:
+    """Exact key for everything a semantic hit must share: prior turns, sampling settings and any template around the text"""
+    raw = json.dumps([history, message.replace(semantic_text, "\0"), max_tokens, temperature])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+# Single-flight - concurrent identical requests share one upstream call
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "true").lower() == "true"
+inflight_requests: Dict[str, asyncio.Task] = {}
+inflight_streams: Dict[str, "StreamFlight"] = {}
+single_flight_stats = {"upstream": 0, "coalesced": 0}
+
+class StreamFlight:
+    """One upstream token stream fanned out to any number of subscribers"""
+
+    def __init__(self, key: str, source: AsyncIterator[str]):
+        self.key = key
+        self.tokens: List[str] = []
+        self.done = False
+        self.error: Optional[Exception] = None
+        self.subscribers = 0
+        self.changed = asyncio.Event()
+        self.task = asyncio.create_task(self._pump(source))
+
+    async def _pump(self, source: AsyncIterator[str]):
+        try:
+            async for token in source:
+                self.tokens.append(token)
+                self._notify()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self._notify()
+            self._detach()
+            await source.aclose()
+
+    def _notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def _detach(self):
+        if inflight_streams.get(self.key) is self:
+            del inflight_streams[self.key]
+
+    async def subscribe(self) -> AsyncIterator[str]:
+        """Replay tokens produced so far, then follow the live stream"""
+        self.subscribers += 1
+        index = 0
+        try:
+            while True:
+                if index < len(self.tokens):
+                    index += 1
+                    yield self.tokens[index - 1]
+                elif self.done:
+                    if self.error:
+                        raise self.error
+                    return
+                else:
+                    await self.changed.wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done:
+                # Last listener left - stop the upstream request
+                self._detach()
+                self.task.cancel()
+
+def _forget_inflight(key: str, task: asyncio.Task):
+    if inflight_requests.get(key) is task:
+        del inflight_requests[key]
+    if not task.cancelled():
+        task.exception()  # Mark as retrieved when every waiter has gone
+
+async def chat_with_ai(message: str, model: str, provider: str, temperature: float = 0.7, max_tokens: int = 2000, use_cache: Optional[bool] = None, hedge: Optional[bool] = None, history: Optional[List[Dict]] = None, semantic_cache_enabled: Optional[bool] = None, semantic_text: Optional[str] = None) -> str:
+    """Chat with AI providers, serving repeated prompts from the response cache.
+
+    history may start with a system turn carrying the stable prompt prefix.
+    With the semantic cache enabled, semantic_text (default: the whole message)
+    is matched by similarity; the rest of the request must match exactly.
+    """
+    messages = normalize_turns((history or []) + [{"role": "user", "content": message}])
+    request_key = response_cache.make_key(provider, model, messages, temperature, max_tokens)
+    use_response_cache = response_cache.should_cache(temperature, use_cache)
+    if use_response_cache:
+        cached = response_cache.get(request_key)
+        if cached is not None:
+            return cached
+    
+    use_semantic_cache = semantic_cache.should_use(semantic_cache_enabled)
+    if use_semantic_cache:
+        semantic_text = semantic_text or message
+        scope = semantic_scope(messages[:-1], messages[-1]["content"], semantic_text, max_tokens, temperature)
+        cached = semantic_cache.get(provider, model, scope, semantic_text)
+        if cached is not None:
+            return cached
+    
+    if not SINGLE_FLIGHT_ENABLED:
+        single_flight_stats["upstream"] += 1
+        response = await hedged_call(messages, model, provider, temperature, max_tokens, hedge)
+    else:
+        task = inflight_requests.get(request_key)
+        if task is None:
+            single_flight_stats["upstream"] += 1
+            task = asyncio.ensure_future(hedged_call(messages, model, provider, temperature, max_tokens, hedge))
+            inflight_requests[request_key] = task
+            task.add_done_callback(lambda t: _forget_inflight(request_key, t))
+        else:
+            single_flight_stats["coalesced"] += 1
+        # Shield so one waiter cancelling does not cancel the shared call
+        response = await asyncio.shield(task)
+    
+    if use_response_cache:
+        response_cache.put(request_key, response)
+    if use_semantic_cache:
+        semantic_cache.put(provider, model, scope, semantic_text, response)
+    return response
+
+# Admission control - per provider/key concurrency cap plus request and token buckets
+class ProviderBusyError(Exception):
+    """Raised when a request waited too long for a provider slot"""
+
+class TokenBucket:
+    """Token bucket refilled continuously at capacity per minute"""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay_for(self, amount: float) -> float:
+        """Seconds until amount can be taken (0 if available now)"""
+        if self.capacity <= 0:
+            return 0.0
+        self._refill()
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount: float):
+        if self.capacity > 0:
+            self.level -= min(amount, self.capacity)
+
+class ProviderLimiter:
+    """FIFO admission queue enforcing max concurrency, RPM and TPM"""
+
+    def __init__(self, name: str, max_concurrency: int, rpm: int, tpm: int, queue_timeout: float):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.queue_timeout = queue_timeout
+        self.waiters: "deque[tuple]" = deque()  # (future, token_cost)
+        self.in_flight = 0
+        self.wakeup: Optional[asyncio.TimerHandle] = None
+        self.admitted = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _dispatch(self):
+        # Strict FIFO: the head of the queue blocks everyone behind it
+        self.wakeup = None
+        while self.waiters:
+            future, cost = self.waiters[0]
+            if future.done():
+                self.waiters.popleft()
+                continue
+            if self.in_flight >= self.max_concurrency:
+                return
+            delay = max(self.requests.delay_for(1), self.tokens.delay_for(cost))
+            if delay > 0:
+                self.wakeup = asyncio.get_running_loop().call_later(delay, self._dispatch)
+                return
+            self.waiters.popleft()
+            self.requests.take(1)
+            self.tokens.take(cost)
+            self.in_flight += 1
+            future.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, token_cost: int):
+        """Hold one admission slot for the duration of the block"""
+        started = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append((future, token_cost))
+        if self.wakeup is None:
+            self._dispatch()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            # Give back a slot granted while we were being cancelled
+            if future.done() and not future.cancelled():
+                self._release()
+            else:
+                future.cancel()
+            if isinstance(e, asyncio.TimeoutError):
+                self.rejected += 1
+                raise ProviderBusyError(f"Provider {self.name} is busy, try again later")
+            raise
+        
+        waited = time.monotonic() - started
+        self.admitted += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _release(self):
+        self.in_flight -= 1
+        if self.wakeup is None:
+            self._dispatch()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": self.in_flight,
+            "queue_depth": sum(1 for future, _ in self.waiters if not future.done()),
+            "max_concurrency": self.max_concurrency,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "avg_wait_ms": round(self.total_wait / self.admitted * 1000, 2) if self.admitted else 0.0,
+            "max_wait_ms": round(self.max_wait * 1000, 2)
+        }
+
+provider_limiters: Dict[tuple, ProviderLimiter] = {}
+
+def provider_setting(provider: str, name: str, default: float) -> float:
+    """Read a per-provider setting such as OPENAI_RPM, falling back to PROVIDER_RPM"""
+    value = os.getenv(f"{provider.upper()}_{name}") or os.getenv(f"PROVIDER_{name}")
+    return float(value) if value else default
+
+def get_provider_limiter(provider: str) -> ProviderLimiter:
+    """Get the admission limiter for a provider and its current API key"""
+    api_key = api_keys.get(provider) or ""
+    key = (provider, hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:12])
+    limiter = provider_limiters.get(key)
+    if limiter is None:
+        limiter = ProviderLimiter(
+            name=provider,
+            max_concurrency=int(provider_setting(provider, "MAX_CONCURRENCY", 16)),
+            rpm=int(provider_setting(provider, "RPM", 0)),
+            tpm=int(provider_setting(provider, "TPM", 0)),
+            queue_timeout=provider_setting(provider, "QUEUE_TIMEOUT", 60)
+        )
+        provider_limiters[key] = limiter
+    return limiter
+
+def estimate_tokens(text: str) -> int:
+    """Rough token estimate (~4 characters per token)"""
+    return len(text) // 4 + 1
+
+def count_message_tokens(messages: List[Dict]) -> int:
+    """Rough token estimate for a chat message list"""
+    return sum(estimate_tokens(m["content"]) for m in messages) + MESSAGE_OVERHEAD_TOKENS * len(messages)
+
+def gemini_contents(messages: List[Dict]) -> List[Dict]:
+    """Convert chat messages to Gemini's role/parts format"""
+    return [
+        {"role": "model" if m["role"] == "assistant" else "user", "parts": [m["content"]]}
+        for m in messages
+    ]
+
+# Prompt-prefix caching - stable content goes first (system prompt, then prior
+# turns) so providers can reuse it. Anthropic needs explicit cache_control
+# breakpoints; OpenAI and Gemini cache long shared prefixes automatically
+PROMPT_CACHE_ENABLED = os.getenv("PROMPT_CACHE_ENABLED", "true").lower() == "true"
+ANTHROPIC_CACHE_CONTROL = {"type": "ephemeral"}
+request_usage: contextvars.ContextVar = contextvars.ContextVar("request_usage", default=None)
+prompt_cache_stats: Dict[tuple, Dict[str, float]] = {}
+
+def split_system(messages: List[Dict]) -> tuple:
+    """Separate a leading system turn: (system text or None, remaining turns)"""
+    if messages and messages[0]["role"] == "system":
+        return messages[0]["content"], messages[1:]
+    return None, messages
+
+def anthropic_prompt(messages: List[Dict]) -> Dict[str, Any]:
+    """system/messages arguments with cache breakpoints after the system prompt and the prior turns"""
+    system, turns = split_system(messages)
+    if not PROMPT_CACHE_ENABLED:
+        return {"system": system, "messages": turns} if system else {"messages": turns}
+    prompt = {"messages": turns}
+    if system:
+        prompt["system"] = [{"type": "text", "text": system, "cache_control": ANTHROPIC_CACHE_CONTROL}]
+    if len(turns) > 1:
+        turns = list(turns)
+        prior = turns[-2]
+        turns[-2] = {
+            "role": prior["role"],
+            "content": [{"type": "text", "text": prior["content"], "cache_control": ANTHROPIC_CACHE_CONTROL}]
+        }
+        prompt["messages"] = turns
+    return prompt
+
+def openai_usage(usage: Any) -> Optional[Dict[str, int]]:
+    if usage is None:
+        return None
+    details = getattr(usage, "prompt_tokens_details", None)
+    return {
+        "input_tokens": usage.prompt_tokens or 0,
+        "output_tokens": usage.completion_tokens or 0,
+        "cache_read_tokens": getattr(details, "cached_tokens", None) or 0,
+        "cache_write_tokens": 0
+    }
+
+def anthropic_usage(usage: Any) -> Optional[Dict[str, int]]:
+    if usage is None:
+        return None
+    cache_read = getattr(usage, "cache_read_input_tokens", None) or 0
+    cache_write = getattr(usage, "cache_creation_input_tokens", None) or 0
+    return {
+        "input_tokens": (usage.input_tokens or 0) + cache_read + cache_write,  # input_tokens excludes cached parts
+        "output_tokens": usage.output_tokens or 0,
+        "cache_read_tokens": cache_read,
+        "cache_write_tokens": cache_write
+    }
+
+def gemini_usage(metadata: Any) -> Optional[Dict[str, int]]:
+    if metadata is None:
+        return None
+    return {
+        "input_tokens": getattr(metadata, "prompt_token_count", None) or 0,
+        "output_tokens": getattr(metadata, "candidates_token_count", None) or 0,
+        "cache_read_tokens": getattr(metadata, "cached_content_token_count", None) or 0,
+        "cache_write_tokens": 0
+    }
+
+def track_request_usage() -> Dict[str, int]:
+    """Collect upstream token usage for the current request, including retries and hedges"""
+    usage = {"input_tokens": 0, "output_tokens": 0, "cache_read_tokens": 0, "cache_write_tokens": 0}
+    request_usage.set(usage)
+    return usage
+
+def record_usage(provider: str, model: str, usage: Optional[Dict[str, int]], seconds: float):
+    """Add one upstream call's usage to the current request and the per-model totals"""
+    if usage is None:
+        return
+    current = request_usage.get()
+    if current is not None:
+        for field, value in usage.items():
+            current[field] += value
+    stats = prompt_cache_stats.get((provider, model))
+    if stats is None:
+        stats = prompt_cache_stats[(provider, model)] = {
+            "requests": 0, "cache_hits": 0, "input_tokens": 0, "output_tokens": 0,
+            "cache_read_tokens": 0, "cache_write_tokens": 0, "hit_seconds": 0.0, "miss_seconds": 0.0
+        }
+    stats["requests"] += 1
+    for field, value in usage.items():
+        stats[field] += value
+    if usage["cache_read_tokens"]:
+        stats["cache_hits"] += 1
+        stats["hit_seconds"] += seconds
+    else:
+        stats["miss_seconds"] += seconds
+
+def prompt_cache_info() -> Dict[str, Any]:
+    info = {}
+    for (provider, model), stats in prompt_cache_stats.items():
+        misses = stats["requests"] - stats["cache_hits"]
+        info[f"{provider}:{model}"] = {
+            **{field: value for field, value in stats.items() if not field.endswith("_seconds")},
+            "cached_input_ratio": round(stats["cache_read_tokens"] / stats["input_tokens"], 4) if stats["input_tokens"] else 0.0,
+            "avg_hit_ms": round(stats["hit_seconds"] * 1000 / stats["cache_hits"]) if stats["cache_hits"] else None,
+            "avg_miss_ms": round(stats["miss_seconds"] * 1000 / misses) if misses else None
+        }
+    return info
+
+# Latency tracking - per provider/model histograms of upstream latency
+class LatencyHistogram:
+    """Log-bucketed latency histogram that decays old samples"""
+
+    BOUNDS = [0.025 * 1.25 ** i for i in range(40)]  # 25ms .. ~150s
+
+    def __init__(self, window: int = 500):
+        self.window = window
+        self.counts = [0.0] * (len(self.BOUNDS) + 1)
+        self.total = 0.0
+        self.samples = 0
+
+    def record(self, seconds: float):
+        index = next((i for i, bound in enumerate(self.BOUNDS) if seconds <= bound), len(self.BOUNDS))
+        self.counts[index] += 1
+        self.total += 1
+        self.samples += 1
+        if self.total > self.window:
+            # Halve all buckets so recent samples dominate
+            self.counts = [count / 2 for count in self.counts]
+            self.total /= 2
+
+    def percentile(self, pct: float) -> Optional[float]:
+        if not self.total:
+            return None
+        target = self.total * pct / 100
+        cumulative = 0.0
+        for i, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return self.BOUNDS[min(i, len(self.BOUNDS) - 1)]
+        return self.BOUNDS[-1]
+
+    def stats(self) -> Dict[str, Any]:
+        p50, p95, p99 = (self.percentile(p) for p in (50, 95, 99))
+        return {
+            "samples": self.samples,
+            "p50_ms": round(p50 * 1000) if p50 else None,
+            "p95_ms": round(p95 * 1000) if p95 else None,
+            "p99_ms": round(p99 * 1000) if p99 else None
+        }
+
+latency_histograms: Dict[tuple, LatencyHistogram] = {}
+
+def record_latency(provider: str, model: str, kind: str, seconds: float):
+    """Record a latency sample; kind is "total" or "first_token" """
+    key = (provider, model, kind)
+    if key not in latency_histograms:
+        latency_histograms[key] = LatencyHistogram()
+    latency_histograms[key].record(seconds)
+
+# Retries and circuit breakers - retry transient provider errors with jittered
+# backoff, and fail fast while a provider keeps failing
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", 3))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", 0.5))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", 8.0))
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+retry_stats = {"retries": 0, "exhausted": 0}
+
+class CircuitOpenError(Exception):
+    """Raised without calling upstream while a provider's breaker is open"""
+
+class CircuitBreaker:
+    """Closed -> open after repeated failures -> half-open single probe -> closed"""
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.times_opened = 0
+
+    def before_call(self):
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError(f"Provider {self.name} is unavailable (circuit open)")
+            self.state = "half_open"
+        if self.state == "half_open":
+            if self.probing:
+                raise CircuitOpenError(f"Provider {self.name} is unavailable (circuit half-open)")
+            self.probing = True
+
+    def record_success(self):
+        if self.state != "closed":
+            logger.info(f"Circuit for {self.name} closed")
+        self.state = "closed"
+        self.failures = 0
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.state == "half_open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            self.times_opened += 1
+            logger.warning(f"Circuit for {self.name} opened after {self.failures} failures")
+
+    def release(self):
+        """End a call that says nothing about provider health"""
+        self.probing = False
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "times_opened": self.times_opened,
+            "retry_in_s": round(max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at)), 1) if self.state == "open" else 0.0
+        }
+
+circuit_breakers: Dict[str, CircuitBreaker] = {}
+
+def get_circuit_breaker(provider: str) -> CircuitBreaker:
+    if provider not in circuit_breakers:
+        circuit_breakers[provider] = CircuitBreaker(
+            provider,
+            failure_threshold=int(provider_setting(provider, "BREAKER_FAILURE_THRESHOLD", 5)),
+            reset_timeout=provider_setting(provider, "BREAKER_RESET_TIMEOUT", 30)
+        )
+    return circuit_breakers[provider]
+
+def is_retryable(error: Exception) -> bool:
+    """Whether a provider error is transient (timeouts, 429s, 5xx)"""
+    cause = error.__cause__ or error
+    status = getattr(cause, "status_code", None)
+    if status is None and isinstance(getattr(cause, "code", None), int):
+        status = cause.code  # google.api_core exceptions
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    return isinstance(cause, (asyncio.TimeoutError, ConnectionError)) or type(cause).__name__ in ("APIConnectionError", "APITimeoutError")
+
+def retry_delay(attempt: int) -> float:
+    """Full-jitter exponential backoff"""
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+async def call_provider(messages: List[Dict], model: str, provider: str, temperature: float = 0.7, max_tokens: int = 2000) -> str:
+    """Send a completion request with admission control, retries and circuit breaking"""
+    if provider == "emergent":
+        return await emergent_router.call(messages, temperature, max_tokens)
+    breaker = get_circuit_breaker(provider)
+    attempt = 0
+    while True:
+        breaker.before_call()
+        try:
+            async with get_provider_limiter(provider).slot(count_message_tokens(messages) + max_tokens):
+                started = time.monotonic()
+                response = await provider_completion(messages, model, provider, temperature, max_tokens)
+        except Exception as e:
+            if not is_retryable(e):
+                breaker.release()
+                raise
+            breaker.record_failure()
+            attempt += 1
+            if attempt >= RETRY_MAX_ATTEMPTS or breaker.state == "open":
+                retry_stats["exhausted"] += 1
+                raise
+            retry_stats["retries"] += 1
+            await asyncio.sleep(retry_delay(attempt - 1))
+            continue
+        except BaseException:
+            breaker.release()
+            raise
+        breaker.record_success()
+        record_latency(provider, model, "total", time.monotonic() - started)
+        return response
+
+async def provider_completion(messages: List[Dict], model: str, provider: str, temperature: float = 0.7, max_tokens: int = 2000) -> str:
+    """Send a single completion request to an AI provider"""
+    started = time.monotonic()
+    try:
+        if provider == "openai":
             api_key = api_keys.get("openai") or "sk-test-key-for-demo"
-            client = openai.OpenAI(api_key=api_key)
-            
-            response = client.chat.completions.create(
-                model=model if provider == "openai" else "gpt-3.5-turbo",
-                messages=[{"role": "user", "content": message}],
-                temperature=temperature,
-                max_tokens=max_tokens
-            )
-            return response.choices[0].message.content
+            async with leased_client("openai", api_key) as client:
+                response = await client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    temperature=temperature,
+                    max_tokens=max_tokens
+                )
+                record_usage(provider, model, openai_usage(getattr(response, "usage", None)), time.monotonic() - started)
+                return response.choices[0].message.content
 
         elif provider == "anthropic" and anthropic:
             api_key = api_keys.get("anthropic")
             if not api_key:
                 raise Exception("Anthropic API key not configured")
             
-            client = anthropic.Anthropic(api_key=api_key)
-            response = client.messages.create(
-                model=model,
-                max_tokens=max_tokens,
-                temperature=temperature,
-                messages=[{"role": "user", "content": message}]
-            )
-            return response.content[0].text
+            async with leased_client("anthropic", api_key) as client:
+                response = await client.messages.create(
+                    model=model,
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                    **anthropic_prompt(messages)
+                )
+                record_usage(provider, model, anthropic_usage(response.usage), time.monotonic() - started)
+                return response.content[0].text
 
         elif provider == "gemini" and genai:
             api_key = api_keys.get("gemini")
             if not api_key:
                 raise Exception("Gemini API key not configured")
             
-            genai.configure(api_key=api_key)
-            model_instance = genai.GenerativeModel(model)
-            response = model_instance.generate_content(message)
-            return response.text
+            system, turns = split_system(messages)
+            async with leased_client("gemini", api_key) as client:
+                model_instance = gemini_model(client, model, system)
+                response = await model_instance.generate_content_async(gemini_contents(turns))
+                record_usage(provider, model, gemini_usage(getattr(response, "usage_metadata", None)), time.monotonic() - started)
+                return response.text
 
         else:
             raise Exception(f"Provider {provider} not supported or not configured")
 
     except Exception as e:
         logger.error(f"AI chat error: {str(e)}")
-        raise Exception(f"AI chat failed: {str(e)}")
+        raise Exception(f"AI chat failed: {str(e)}") from e
+
+async def stream_chat_with_ai(message: str, model: str, provider: str, temperature: float = 0.7, max_tokens: int = 2000, use_cache: Optional[bool] = None, hedge: Optional[bool] = None, history: Optional[List[Dict]] = None) -> AsyncIterator[str]:
+    """Stream response text from AI providers, replaying cached responses whole"""
+    messages = normalize_turns((history or []) + [{"role": "user", "content": message}])
+    request_key = response_cache.make_key(provider, model, messages, temperature, max_tokens)
+    use_response_cache = response_cache.should_cache(temperature, use_cache)
+    if use_response_cache:
+        cached = response_cache.get(request_key)
+        if cached is not None:
+            yield cached
+            return
+    
+    if not SINGLE_FLIGHT_ENABLED:
+        single_flight_stats["upstream"] += 1
+        tokens = hedged_stream(messages, model, provider, temperature, max_tokens, hedge)
+    else:
+        flight = inflight_streams.get(request_key)
+        if flight is None:
+            single_flight_stats["upstream"] += 1
+            flight = StreamFlight(request_key, hedged_stream(messages, model, provider, temperature, max_tokens, hedge))
+            inflight_streams[request_key] = flight
+        else:
+            single_flight_stats["coalesced"] += 1
+        tokens = flight.subscribe()
+    
+    parts = []
+    try:
+        async for token in tokens:
+            parts.append(token)
+            yield token
+    finally:
+        await tokens.aclose()
+    if use_response_cache:
+        response_cache.put(request_key, "".join(parts))
+
+async def stream_provider(messages: List[Dict], model: str, provider: str, temperature: float = 0.7, max_tokens: int = 2000) -> AsyncIterator[str]:
+    """Stream a response, retrying only failures that happen before the first token"""
+    if provider == "emergent":
+        async for token in emergent_router.stream(messages, temperature, max_tokens):
+            yield token
+        return
+    breaker = get_circuit_breaker(provider)
+    attempt = 0
+    while True:
+        breaker.before_call()
+        first_token = True
+        try:
+            async with get_provider_limiter(provider).slot(count_message_tokens(messages) + max_tokens):
+                started = time.monotonic()
+                tokens = provider_stream(messages, model, provider, temperature, max_tokens)
+                try:
+                    async for token in tokens:
+                        if first_token:
+                            record_latency(provider, model, "first_token", time.monotonic() - started)
+                            first_token = False
+                        yield token
+                finally:
+                    await tokens.aclose()
+        except Exception as e:
+            if not is_retryable(e):
+                breaker.release()
+                raise
+            breaker.record_failure()
+            attempt += 1
+            if not first_token or attempt >= RETRY_MAX_ATTEMPTS or breaker.state == "open":
+                retry_stats["exhausted"] += 1
+                raise
+            retry_stats["retries"] += 1
+            await asyncio.sleep(retry_delay(attempt - 1))
+            continue
+        except BaseException:
+            breaker.release()
+            raise
+        breaker.record_success()
+        record_latency(provider, model, "total", time.monotonic() - started)
+        return
+
+async def provider_stream(messages: List[Dict], model: str, provider: str, temperature: float = 0.7, max_tokens: int = 2000) -> AsyncIterator[str]:
+    """Stream response text from an AI provider as it is generated"""
+    started = time.monotonic()
+    try:
+        if provider == "openai":
+            api_key = api_keys.get("openai") or "sk-test-key-for-demo"
+            async with leased_client("openai", api_key) as client:
+                stream = await client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    stream=True,
+                    stream_options={"include_usage": True}
+                )
+                try:
+                    async for chunk in stream:
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            yield chunk.choices[0].delta.content
+                        if getattr(chunk, "usage", None):
+                            # Sent as a final chunk with no choices
+                            record_usage(provider, model, openai_usage(chunk.usage), time.monotonic() - started)
+                finally:
+                    # Closing the stream aborts the upstream request early
+                    await stream.close()
+
+        elif provider == "anthropic" and anthropic:
+            api_key = api_keys.get("anthropic")
+            if not api_key:
+                raise Exception("Anthropic API key not configured")
+            
+            async with leased_client("anthropic", api_key) as client:
+                async with client.messages.stream(
+                    model=model,
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                    **anthropic_prompt(messages)
+                ) as stream:
+                    async for text in stream.text_stream:
+                        yield text
+                    final = await stream.get_final_message()
+                    record_usage(provider, model, anthropic_usage(final.usage), time.monotonic() - started)
+
+        elif provider == "gemini" and genai:
+            api_key = api_keys.get("gemini")
+            if not api_key:
+                raise Exception("Gemini API key not configured")
+            
+            system, turns = split_system(messages)
+            async with leased_client("gemini", api_key) as client:
+                model_instance = gemini_model(client, model, system)
+                response = await model_instance.generate_content_async(gemini_contents(turns), stream=True)
+                metadata = None
+                async for chunk in response:
+                    metadata = getattr(chunk, "usage_metadata", None) or metadata
+                    if chunk.text:
+                        yield chunk.text
+                record_usage(provider, model, gemini_usage(metadata), time.monotonic() - started)
+
+        else:
+            raise Exception(f"Provider {provider} not supported or not configured")
+
+    except Exception as e:
+        logger.error(f"AI stream error: {str(e)}")
+        raise Exception(f"AI chat failed: {str(e)}") from e
+
+# Emergent router - picks the best healthy backend from MODELS["emergent"]
+# Approximate blended USD per 1K tokens, used only to rank backends
+MODEL_COSTS = {
+    "gpt-4o": 0.0075, "gpt-4o-mini": 0.0004, "gpt-4-turbo": 0.02, "gpt-4": 0.045, "gpt-3.5-turbo": 0.001,
+    "claude-3-5-sonnet-20241022": 0.009, "claude-3-5-haiku-20241022": 0.0024,
+    "claude-3-opus-20240229": 0.045, "claude-3-sonnet-20240229": 0.009,
+    "gemini-2.0-flash": 0.00025, "gemini-1.5-pro": 0.003, "gemini-1.5-flash": 0.0002
+}
+
+class BackendHealth:
+    """Rolling health statistics for one router backend"""
+
+    def __init__(self):
+        self.latency: Optional[float] = None  # EWMA seconds
+        self.error_rate = 0.0  # EWMA of failures
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.requests = 0
+
+class ModelRouter:
+    """Routes requests across backends by EWMA latency, error rate and cost"""
+
+    def __init__(self, models: List[str]):
+        self.alpha = float(os.getenv("ROUTER_EWMA_ALPHA", 0.2))
+        self.failure_threshold = int(os.getenv("ROUTER_EJECT_AFTER_FAILURES", 3))
+        self.cooldown = float(os.getenv("ROUTER_EJECT_COOLDOWN", 30))
+        self.latency_weight = float(os.getenv("ROUTER_LATENCY_WEIGHT", 1.0))  # per second
+        self.error_weight = float(os.getenv("ROUTER_ERROR_WEIGHT", 10.0))
+        self.cost_weight = float(os.getenv("ROUTER_COST_WEIGHT", 100.0))  # per USD
+        # EWMA tokens per request, shared by all backends: cost is the same
+        # workload priced per model, so every backend is ranked in USD per request
+        self.expected_tokens = 1000.0
+        self.backends = {}
+        for model in models:
+            provider = next((p for p, names in MODELS.items() if p != "emergent" and model in names), None)
+            if provider:
+                self.backends[(provider, model)] = BackendHealth()
+
+    @staticmethod
+    def configured(provider: str) -> bool:
+        if provider == "openai":
+            return True  # Falls back to the demo key
+        if provider == "anthropic":
+            return bool(anthropic and api_keys.get("anthropic"))
+        if provider == "gemini":
+            return bool(genai and api_keys.get("gemini"))
+        return False
+
+    def score(self, backend: tuple) -> float:
+        health = self.backends[backend]
+        latency = health.latency if health.latency is not None else 1.0  # Optimistic prior explores new backends
+        cost = MODEL_COSTS.get(backend[1], 0.0) * self.expected_tokens / 1000
+        return latency * self.latency_weight + health.error_rate * self.error_weight + cost * self.cost_weight
+
+    def ranked(self) -> List[tuple]:
+        """Configured backends, healthy ones best-first, then ejected ones by release time"""
+        now = time.monotonic()
+        candidates = [backend for backend in self.backends if self.configured(backend[0])]
+        healthy = sorted((b for b in candidates if self.backends[b].ejected_until <= now), key=self.score)
+        ejected = sorted((b for b in candidates if self.backends[b].ejected_until > now), key=lambda b: self.backends[b].ejected_until)
+        if not candidates:
+            raise Exception("No emergent backends are configured")
+        return healthy + ejected
+
+    def record_success(self, backend: tuple, latency: float, tokens: int):
+        health = self.backends[backend]
+        health.requests += 1
+        health.consecutive_failures = 0
+        health.latency = latency if health.latency is None else health.latency + self.alpha * (latency - health.latency)
+        health.error_rate += self.alpha * (0.0 - health.error_rate)
+        self.expected_tokens += self.alpha * (tokens - self.expected_tokens)
+
+    def record_failure(self, backend: tuple):
+        health = self.backends[backend]
+        health.requests += 1
+        health.consecutive_failures += 1
+        health.error_rate += self.alpha * (1.0 - health.error_rate)
+        if health.consecutive_failures >= self.failure_threshold:
+            health.ejected_until = time.monotonic() + self.cooldown
+            health.consecutive_failures = 0
+            logger.warning(f"Emergent router ejected {backend[0]}:{backend[1]} for {self.cooldown}s")
+
+    async def call(self, messages: List[Dict], temperature: float, max_tokens: int) -> str:
+        """Try backends best-first until one succeeds"""
+        error = None
+        for provider, model in self.ranked():
+            started = time.monotonic()
+            try:
+                response = await call_provider(messages, model, provider, temperature, max_tokens)
+            except (ProviderBusyError, CircuitOpenError) as e:
+                error = e  # Saturated or already known to be down
+                continue
+            except Exception as e:
+                self.record_failure((provider, model))
+                error = e
+                continue
+            self.record_success((provider, model), time.monotonic() - started, count_message_tokens(messages) + estimate_tokens(response))
+            return response
+        raise error
+
+    async def stream(self, messages: List[Dict], temperature: float, max_tokens: int) -> AsyncIterator[str]:
+        """Stream from the best backend, failing over only before the first token"""
+        error = None
+        for provider, model in self.ranked():
+            started = time.monotonic()
+            parts = []
+            tokens = stream_provider(messages, model, provider, temperature, max_tokens)
+            try:
+                async for token in tokens:
+                    parts.append(token)
+                    yield token
+            except (ProviderBusyError, CircuitOpenError) as e:
+                error = e
+                continue
+            except Exception as e:
+                self.record_failure((provider, model))
+                if parts:
+                    raise
+                error = e
+                continue
+            finally:
+                await tokens.aclose()
+            self.record_success((provider, model), time.monotonic() - started, count_message_tokens(messages) + estimate_tokens("".join(parts)))
+            return
+        raise error
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        return {
+            f"{provider}:{model}": {
+                "score": round(self.score((provider, model)), 4),
+                "latency_ms": round(health.latency * 1000) if health.latency is not None else None,
+                "error_rate": round(health.error_rate, 4),
+                "requests": health.requests,
+                "ejected_for_s": round(max(0.0, health.ejected_until - now), 1)
+            }
+            for (provider, model), health in self.backends.items()
+        }
+
+emergent_router = ModelRouter(MODELS["emergent"])
+
+# Hedged requests - race a fallback model when the primary is slower than usual
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "false").lower() == "true"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", 95))
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", 3.0))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", 20))
+HEDGE_FALLBACKS: Dict[str, str] = json.loads(os.getenv("HEDGE_FALLBACKS", "{}"))  # "provider:model" -> "provider:model"
+hedge_stats = {"hedged": 0, "fallback_wins": 0, "primary_wins": 0}
+
+def hedge_target(provider: str, model: str) -> Optional[tuple]:
+    """Configured (provider, model) fallback for a primary, if it is a known model"""
+    target = HEDGE_FALLBACKS.get(f"{provider}:{model}") or HEDGE_FALLBACKS.get(provider)
+    if not target or ":" not in target:
+        return None
+    fallback_provider, fallback_model = target.split(":", 1)
+    if fallback_model not in MODELS.get(fallback_provider, []):
+        logger.warning(f"Ignoring unknown hedge fallback: {target}")
+        return None
+    return fallback_provider, fallback_model
+
+def hedge_delay(provider: str, model: str, kind: str) -> float:
+    """How long to wait on the primary before firing the fallback"""
+    histogram = latency_histograms.get((provider, model, kind))
+    if histogram is None or histogram.samples < HEDGE_MIN_SAMPLES:
+        return HEDGE_DEFAULT_DELAY
+    return histogram.percentile(HEDGE_PERCENTILE)
+
+async def cancel_tasks(tasks):
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+async def hedged_call(messages: List[Dict], model: str, provider: str, temperature: float = 0.7, max_tokens: int = 2000, hedge: Optional[bool] = None) -> str:
+    """Call the primary model, racing the fallback if it is slow or fails"""
+    fallback = hedge_target(provider, model) if (HEDGE_ENABLED if hedge is None else hedge) else None
+    if fallback is None:
+        return await call_provider(messages, model, provider, temperature, max_tokens)
+    
+    primary = asyncio.ensure_future(call_provider(messages, model, provider, temperature, max_tokens))
+    racers = {primary}
+    secondary = None
+    try:
+        done, _ = await asyncio.wait(racers, timeout=hedge_delay(provider, model, "total"))
+        if primary in done and not primary.exception():
+            return primary.result()
+        
+        hedge_stats["hedged"] += 1
+        fallback_provider, fallback_model = fallback
+        secondary = asyncio.ensure_future(call_provider(messages, fallback_model, fallback_provider, temperature, max_tokens))
+        racers = {secondary} if primary in done else {primary, secondary}
+        error = primary.exception() if primary in done else None
+        while racers:
+            done, racers = await asyncio.wait(racers, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    hedge_stats["fallback_wins" if task is secondary else "primary_wins"] += 1
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        await cancel_tasks([task for task in (primary, secondary) if task and not task.done()])
+
+async def hedged_stream(messages: List[Dict], model: str, provider: str, temperature: float = 0.7, max_tokens: int = 2000, hedge: Optional[bool] = None) -> AsyncIterator[str]:
+    """Stream from the primary model, racing the fallback on a slow first token"""
+    fallback = hedge_target(provider, model) if (HEDGE_ENABLED if hedge is None else hedge) else None
+    primary = stream_provider(messages, model, provider, temperature, max_tokens)
+    pending = {asyncio.ensure_future(primary.__anext__()): primary}
+    timeout = hedge_delay(provider, model, "first_token") if fallback else None
+    winner = None
+    first_token = None
+    error = None
+    hedged = False
+    try:
+        while winner is None:
+            done = set()
+            if pending:
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                stream = pending.pop(task)
+                try:
+                    first_token = task.result()
+                    winner = stream
+                    break
+                except StopAsyncIteration:
+                    winner = stream
+                    break
+                except Exception as e:
+                    error = e
+                    await stream.aclose()
+            if winner is None and fallback:
+                # Primary is slow or failed - start the fallback race
+                hedge_stats["hedged"] += 1
+                hedged = True
+                fallback_provider, fallback_model = fallback
+                secondary = stream_provider(messages, fallback_model, fallback_provider, temperature, max_tokens)
+                pending[asyncio.ensure_future(secondary.__anext__())] = secondary
+                fallback = None
+                timeout = None
+            elif winner is None and not pending:
+                raise error
+    finally:
+        await cancel_tasks(list(pending))
+        for stream in pending.values():
+            await stream.aclose()
+    
+    if hedged:
+        hedge_stats["fallback_wins" if winner is not primary else "primary_wins"] += 1
+    try:
+        if first_token is not None:
+            yield first_token
+            async for token in winner:
+                yield token
+    finally:
+        await winner.aclose()
+
+# Session registry - idle TTL, session count and memory limits for in-memory
+# session state; evicted sessions are reloaded from SQLite when persistence is on
+def dict_bytes(value: Dict) -> int:
+    """Approximate memory held by a flat dict such as a summary"""
+    return sys.getsizeof(value) + sum(sys.getsizeof(item) for item in value.values())
+
+class SessionRegistry:
+    """Tracks per-session memory and evicts idle or least-recently-used sessions"""
+
+    def __init__(self, idle_ttl: float, max_sessions: int, max_bytes: int, sweep_interval: float):
+        self.idle_ttl = idle_ttl
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.sweep_interval = sweep_interval
+        self.sessions: "OrderedDict[str, List[float]]" = OrderedDict()  # session_id -> [last_seen, bytes]
+        self.total_bytes = 0
+        self.on_evict: List[Any] = []  # Callbacks that drop a session's in-memory state
+        self.evictions = {"idle": 0, "capacity": 0}
+
+    def track(self, session_id: str, size: int):
+        """Register a freshly loaded session and its full size"""
+        usage = self.sessions.pop(session_id, None)
+        if usage:
+            self.total_bytes -= usage[1]
+        self.sessions[session_id] = [time.monotonic(), size]
+        self.total_bytes += size
+        self.enforce_limits(keep=session_id)
+
+    def touch(self, session_id: str, added_bytes: int = 0):
+        usage = self.sessions.get(session_id)
+        if usage is None:
+            self.track(session_id, added_bytes)
+            return
+        self.sessions.move_to_end(session_id)
+        usage[0] = time.monotonic()
+        usage[1] += added_bytes
+        self.total_bytes += added_bytes
+        if added_bytes:
+            self.enforce_limits(keep=session_id)
+
+    def evict(self, session_id: str, reason: str):
+        usage = self.sessions.pop(session_id, None)
+        if usage is None:
+            return
+        self.total_bytes -= usage[1]
+        self.evictions[reason] += 1
+        for callback in self.on_evict:
+            callback(session_id)
+
+    def enforce_limits(self, keep: Optional[str] = None):
+        """Evict least-recently-used sessions until under the count and byte limits"""
+        while len(self.sessions) > self.max_sessions or self.total_bytes > self.max_bytes:
+            oldest = next(iter(self.sessions))
+            if oldest == keep:
+                break
+            self.evict(oldest, "capacity")
+
+    def sweep(self):
+        cutoff = time.monotonic() - self.idle_ttl
+        while self.sessions:
+            session_id, (last_seen, _) = next(iter(self.sessions.items()))
+            if last_seen > cutoff:
+                break
+            self.evict(session_id, "idle")
+
+    async def sweep_forever(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            self.sweep()
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            "sessions": len(self.sessions),
+            "bytes": self.total_bytes,
+            "max_sessions": self.max_sessions,
+            "max_bytes": self.max_bytes,
+            "idle_ttl": self.idle_ttl,
+            "evictions": self.evictions
+        }
+
+session_registry = SessionRegistry(
+    idle_ttl=float(os.getenv("SESSION_IDLE_TTL", 86400)),
+    max_sessions=int(os.getenv("SESSION_MAX_COUNT", 1000)),
+    max_bytes=int(os.getenv("SESSION_MAX_BYTES", 256 * 1024 * 1024)),
+    sweep_interval=float(os.getenv("SESSION_SWEEP_INTERVAL", 60))
+)
+
+# Message records - one slotted object per stored turn. Role/model/provider
+# strings are interned so millions of turns share a handful of objects, and
+# the timestamp is epoch milliseconds; the JSON shape is produced by to_dict()
+class MessageRecord:
+    """Compact stored chat turn"""
+
+    __slots__ = ("id", "role", "content", "timestamp", "tokens", "model", "provider")
+
+    def __init__(self, id: int, role: str, content: str, timestamp: int, tokens: Optional[int] = None,
+                 model: Optional[str] = None, provider: Optional[str] = None):
+        self.id = id
+        self.role = sys.intern(role)
+        self.content = content
+        self.timestamp = timestamp
+        self.tokens = tokens if tokens is not None else estimate_tokens(content)
+        self.model = sys.intern(model) if model else None
+        self.provider = sys.intern(provider) if provider else None
+
+    def nbytes(self) -> int:
+        """Memory owned by this record (interned strings and small ints are shared)"""
+        return sys.getsizeof(self) + sys.getsizeof(self.content)
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = {
+            "id": self.id,
+            "role": self.role,
+            "content": self.content,
+            "timestamp": datetime.fromtimestamp(self.timestamp / 1000).isoformat(),
+            "tokens": self.tokens
+        }
+        if self.model:
+            data["model"] = self.model
+            data["provider"] = self.provider
+        return data
+
+def epoch_ms(value: Optional[datetime] = None) -> int:
+    return int((value or datetime.now()).timestamp() * 1000)
+
+# Conversation store - SQLite (WAL) persistence with write-behind batching;
+# hot sessions stay in memory under the session registry's limits
+class ConversationStore:
+    """Append-only per-session message log backed by SQLite"""
+
+    SCHEMA = [
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        """CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY,
+            session_id TEXT NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            timestamp INTEGER,
+            tokens INTEGER,
+            model TEXT,
+            provider TEXT
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_messages_session ON messages (session_id, id)",
+        """CREATE TABLE IF NOT EXISTS summaries (
+            session_id TEXT PRIMARY KEY,
+            summary TEXT NOT NULL,
+            covered INTEGER NOT NULL,
+            tokens INTEGER,
+            updated TEXT
+        )""",
+        "CREATE TABLE IF NOT EXISTS workers (id INTEGER PRIMARY KEY AUTOINCREMENT, started TEXT)"
+    ]
+    COLUMNS = ("id", "session_id", "role", "content", "timestamp", "tokens", "model", "provider")
+
+    def __init__(self, db_path: Optional[str], flush_interval: float, batch_size: int):
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.cache: Dict[str, List[Dict]] = {}
+        self.summaries: Dict[str, Dict] = {}  # session_id -> {summary, covered (last message id), tokens, updated}
+        self.synced: Dict[str, int] = {}  # session_id -> epoch ms of the last read from SQLite
+        self.pending: List[tuple] = []  # (session_id, entry) not yet handed to the writer
+        self.flushing: List[tuple] = []  # batch currently being written
+        self.write_job: Optional[asyncio.Future] = None  # executor write of self.flushing
+        self.executor: Optional[ThreadPoolExecutor] = None  # One thread owns the connection; created by start()
+        self.conn: Optional[sqlite3.Connection] = None
+        self.flush_event: Optional[asyncio.Event] = None
+        self.writer: Optional[asyncio.Task] = None
+        # Message ids are millisecond timestamps with a worker number in the low
+        # bits: they sort by time, stay unique across uvicorn workers and fit
+        # in a JavaScript number. Persistent stores claim the number from a
+        # database sequence on start; until then (or in memory) it is random
+        self.worker_bits = random.getrandbits(10)
+        self.last_id = 0
+        self.stats = {"cache_hits": 0, "cache_misses": 0, "rows_written": 0, "flushes": 0}
+
+    @property
+    def persistent(self) -> bool:
+        return bool(self.db_path)
+
+    def next_id(self) -> int:
+        candidate = (time.time_ns() // 1000000) << 10 | self.worker_bits
+        self.last_id = max(candidate, ((self.last_id >> 10) + 1) << 10 | self.worker_bits)
+        return self.last_id
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    def _connect(self) -> int:
+        """Open the database and claim this process's worker number"""
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        for statement in self.SCHEMA:
+            self.conn.execute(statement)
+        worker = self.conn.execute("INSERT INTO workers (started) VALUES (?)", (datetime.now().isoformat(),)).lastrowid
+        self.conn.commit()
+        return worker % 1024
+
+    def _write(self, batch: List[tuple]) -> List[tuple]:
+        """Insert a batch; returns the entries whose id already belongs to a different message"""
+        rows = [
+            (record.id, session_id, record.role, record.content, record.timestamp,
+             record.tokens, record.model, record.provider)
+            for session_id, record in batch
+        ]
+        # Plain INSERT: an id collision must never overwrite another worker's row
+        insert = f"INSERT INTO messages ({', '.join(self.COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+        try:
+            self.conn.executemany(insert, rows)
+            self.conn.commit()
+            return []
+        except sqlite3.IntegrityError:
+            self.conn.rollback()
+        except BaseException:
+            self.conn.rollback()  # So the retried batch doesn't collide with its own partial insert
+            raise
+        # Row by row so one duplicate id can't hold back the rest of the batch
+        conflicts = []
+        try:
+            for row, entry in zip(rows, batch):
+                try:
+                    self.conn.execute(insert, row)
+                except sqlite3.IntegrityError:
+                    existing = self.conn.execute("SELECT session_id, content FROM messages WHERE id = ?", (row[0],)).fetchone()
+                    if existing != (row[1], row[3]):
+                        conflicts.append(entry)  # Otherwise this exact row is already stored
+            self.conn.commit()
+        except BaseException:
+            self.conn.rollback()
+            raise
+        return conflicts
+
+    def _write_summary(self, session_id: str, summary: Dict):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO summaries (session_id, summary, covered, tokens, updated) VALUES (?, ?, ?, ?, ?)",
+            (session_id, summary["summary"], summary["covered"], summary["tokens"], summary["updated"])
+        )
+        self.conn.commit()
+
+    def _read_summary(self, session_id: str) -> Optional[Dict]:
+        row = self.conn.execute(
+            "SELECT summary, covered, tokens, updated FROM summaries WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {"summary": row[0], "covered": row[1], "tokens": row[2], "updated": row[3]}
+
+    def _read(self, session_id: str, after: int = 0) -> List[MessageRecord]:
+        cursor = self.conn.execute(
+            "SELECT id, role, content, timestamp, tokens, model, provider FROM messages WHERE session_id = ? AND id > ? ORDER BY id",
+            (session_id, after)
+        )
+        records = []
+        for message_id, role, content, timestamp, tokens, model, provider in cursor:
+            if isinstance(timestamp, str):
+                timestamp = epoch_ms(datetime.fromisoformat(timestamp))  # Rows written before records were compact
+            records.append(MessageRecord(message_id, role, content, timestamp, tokens, model, provider))
+        return records
+
+    def _read_session(self, session_id: str, after: int = 0) -> tuple:
+        """Messages and summary from one executor hop, so no flush can land in between"""
+        return self._read(session_id, after), self._read_summary(session_id)
+
+    async def start(self):
+        if not self.persistent:
+            return
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="conversation-db")
+        self.worker_bits = await self._run(self._connect)
+        self.flush_event = asyncio.Event()
+        self.writer = asyncio.create_task(self._write_behind())
+        logger.info(f"Conversation store using SQLite at {self.db_path}")
+
+    async def stop(self):
+        if self.writer:
+            self.writer.cancel()
+            await asyncio.gather(self.writer, return_exceptions=True)
+            self.writer = None
+        if self.conn:
+            await self.flush()  # Also settles a write the cancelled writer left running
+            await self._run(self.conn.close)
+            self.conn = None
+        if self.executor:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    async def _write_behind(self):
+        """Flush pending appends every flush_interval, or sooner when a batch fills up"""
+        while True:
+            try:
+                await asyncio.wait_for(self.flush_event.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.flush_event.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Conversation store flush failed: {str(e)}")
+                await asyncio.sleep(self.flush_interval)
+
+    async def flush(self):
+        while self.conn and (self.pending or self.write_job):
+            if self.write_job is None:
+                self.flushing, self.pending = self.pending[:self.batch_size], self.pending[self.batch_size:]
+                self.write_job = asyncio.ensure_future(self._run(self._write, self.flushing))
+            job = self.write_job
+            # asyncio.wait doesn't cancel the job if we are cancelled: the executor
+            # keeps writing, so the batch stays in flushing until it settles
+            await asyncio.wait([job])
+            if self.write_job is not job:
+                continue  # A concurrent flush already settled this batch
+            batch, self.flushing, self.write_job = self.flushing, [], None
+            try:
+                conflicts = job.result()
+            except BaseException:
+                self.pending = batch + self.pending  # Retry on the next flush
+                raise
+            for session_id, record in conflicts:
+                # The next id up keeps the message between its neighbours, whose
+                # ids differ by at least a millisecond (1024)
+                record.id += 1
+                logger.warning(f"Conversation store: message id {record.id - 1} already taken, retrying as {record.id}")
+            self.pending = conflicts + self.pending
+            self.stats["rows_written"] += len(batch) - len(conflicts)
+            self.stats["flushes"] += 1
+
+    def cached(self, session_id: str) -> Optional[List[MessageRecord]]:
+        return self.cache.get(session_id)
+
+    async def load(self, session_id: str) -> List[MessageRecord]:
+        """Session messages in order, from the hot cache or an indexed read"""
+        entries = self.cache.get(session_id)
+        if entries is not None:
+            session_registry.touch(session_id)
+            self.stats["cache_hits"] += 1
+            if self.conn:
+                await self._catch_up(session_id, entries)
+            return entries
+        
+        self.stats["cache_misses"] += 1
+        self.synced[session_id] = epoch_ms()
+        # Snapshot unsaved appends before yielding: a flush may commit and clear
+        # them while the read is in flight
+        unsaved = [record for sid, record in self.flushing + self.pending if sid == session_id]
+        entries, summary = [], None
+        if self.conn:
+            entries, summary = await self._run(self._read_session, session_id)
+        # Merge appends the writer had not committed when the read ran
+        unsaved += [record for sid, record in self.flushing + self.pending if sid == session_id]
+        seen = {record.id for record in entries}
+        unsaved = list({record.id: record for record in unsaved if record.id not in seen}.values())
+        if unsaved:
+            entries = sorted(entries + unsaved, key=lambda record: record.id)
+        if session_id in self.cache:
+            # Another coroutine loaded it while we were reading
+            return self.cache[session_id]
+        self.cache[session_id] = entries
+        if summary and session_id not in self.summaries:
+            self.summaries[session_id] = self._upgrade_summary(summary, entries)
+        size = sum(record.nbytes() for record in entries)
+        if session_id in self.summaries:
+            size += dict_bytes(self.summaries[session_id])
+        session_registry.track(session_id, size)
+        return entries
+
+    async def _catch_up(self, session_id: str, entries: List[MessageRecord]):
+        """Merge rows other workers committed since this session was read (uvicorn workers share no cache)"""
+        synced = epoch_ms()
+        # Another worker's write-behind may commit a row up to a flush interval
+        # after its id was minted, so re-read that far back and skip known ids
+        lag = int(self.flush_interval * 1000) + 5000
+        after = max(0, self.synced.get(session_id, 0) - lag) << 10
+        records, summary = await self._run(self._read_session, session_id, after)
+        self.synced[session_id] = synced
+        if records:
+            known = {record.id for record in entries[bisect.bisect_right(entries, after, key=lambda record: record.id):]}
+            fresh = [record for record in records if record.id not in known]
+            if fresh:
+                ordered = not entries or fresh[0].id > entries[-1].id
+                entries.extend(fresh)
+                if not ordered:
+                    entries.sort(key=lambda record: record.id)
+                session_registry.touch(session_id, sum(record.nbytes() for record in fresh))
+        current = self.summaries.get(session_id)
+        if summary and (current is None or summary["covered"] > current["covered"]):
+            self.summaries[session_id] = self._upgrade_summary(summary, entries)
+
+    @staticmethod
+    def _upgrade_summary(summary: Dict, entries: List[MessageRecord]) -> Dict:
+        """Summaries written before 'covered' held a message id stored a turn count"""
+        covered = summary["covered"]
+        if 0 < covered < 1 << 32:
+            summary["covered"] = entries[min(covered, len(entries)) - 1].id if entries else 0
+        return summary
+
+    def append(self, session_id: str, role: str, content: str, model: Optional[str] = None, provider: Optional[str] = None) -> MessageRecord:
+        record = MessageRecord(self.next_id(), role, content, epoch_ms(), model=model, provider=provider)
+        entries = self.cache.get(session_id)
+        if entries is not None:
+            entries.append(record)
+            session_registry.touch(session_id, record.nbytes())
+        elif not self.persistent:
+            self.cache[session_id] = [record]
+            session_registry.track(session_id, record.nbytes())
+        if self.persistent:
+            self.pending.append((session_id, record))
+            if len(self.pending) >= self.batch_size and self.flush_event:
+                self.flush_event.set()
+        return record
+
+    async def save_summary(self, session_id: str, summary: Dict):
+        """Replace a session's rolling summary, writing it through to SQLite"""
+        previous = self.summaries.get(session_id)
+        self.summaries[session_id] = summary
+        if session_id in self.cache:
+            session_registry.touch(session_id, dict_bytes(summary) - (dict_bytes(previous) if previous else 0))
+        if self.conn:
+            await self._run(self._write_summary, session_id, summary)
+
+    def evict(self, session_id: str):
+        """Drop a session's in-memory state; persisted rows are reloaded on demand"""
+        self.cache.pop(session_id, None)
+        self.summaries.pop(session_id, None)
+        self.synced.pop(session_id, None)
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "persistent": self.persistent,
+            "hot_sessions": len(self.cache),
+            "pending_writes": len(self.pending) + len(self.flushing)
+        }
+
+def conversation_db_path() -> Optional[str]:
+    """SQLite file from DATABASE_URL (sqlite:///path); empty disables persistence"""
+    url = os.getenv("DATABASE_URL", "sqlite:///./ai_engineer.db")
+    if not url.startswith("sqlite:///"):
+        if url:
+            logger.warning(f"Unsupported DATABASE_URL for conversations, keeping them in memory: {url}")
+        return None
+    return url[len("sqlite:///"):]
+
+conversation_store = ConversationStore(
+    db_path=conversation_db_path(),
+    flush_interval=float(os.getenv("CONVERSATION_FLUSH_INTERVAL", 0.25)),
+    batch_size=int(os.getenv("CONVERSATION_FLUSH_BATCH", 500))
+)
+session_registry.on_evict.append(conversation_store.evict)
+
+# Multi-turn context - prior turns are sent upstream under a per-model token budget
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-4o": 128000, "gpt-4o-mini": 128000, "gpt-4-turbo": 128000, "gpt-4": 8192, "gpt-3.5-turbo": 16385,
+    "claude-3-5-sonnet-20241022": 200000, "claude-3-5-haiku-20241022": 200000,
+    "claude-3-opus-20240229": 200000, "claude-3-sonnet-20240229": 200000,
+    "gemini-2.0-flash": 1048576, "gemini-1.5-pro": 2097152, "gemini-1.5-flash": 1048576
+}
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", 8000))  # 0 disables history
+HISTORY_MIN_TRUNCATED_TOKENS = 64
+MESSAGE_OVERHEAD_TOKENS = 4
+
+def entry_tokens(record: MessageRecord) -> int:
+    """Token count for a history entry, computed once and cached on the record"""
+    if record.tokens is None:
+        record.tokens = estimate_tokens(record.content)
+    return record.tokens
+
+def context_window(model: str, provider: str) -> int:
+    if provider == "emergent":
+        return min(MODEL_CONTEXT_WINDOWS.get(m, 8192) for m in MODELS["emergent"])
+    return MODEL_CONTEXT_WINDOWS.get(model, 8192)
+
+def history_budget(model: str, provider: str, reserved: int) -> int:
+    """Tokens available for prior turns after the prompt and completion are reserved"""
+    return max(0, min(HISTORY_TOKEN_BUDGET, context_window(model, provider) - reserved))
+
+def window_history(history: List[MessageRecord], budget: int) -> List[Dict]:
+    """Select prior turns newest-first until the budget is spent, truncating the oldest one kept"""
+    selected = []
+    remaining = budget
+    for entry in reversed(history):
+        tokens = entry_tokens(entry) + MESSAGE_OVERHEAD_TOKENS
+        if tokens <= remaining:
+            selected.append({"role": entry.role, "content": entry.content})
+            remaining -= tokens
+            continue
+        if remaining >= HISTORY_MIN_TRUNCATED_TOKENS:
+            # Keep the most recent part of the turn that straddles the budget
+            chars = (remaining - MESSAGE_OVERHEAD_TOKENS) * 4
+            selected.append({"role": entry.role, "content": "[earlier text truncated] " + entry.content[-chars:]})
+        break
+    selected.reverse()
+    return selected
+
+def normalize_turns(messages: List[Dict]) -> List[Dict]:
+    """Merge consecutive same-role turns and start on a user turn, as Anthropic requires.
+
+    A leading system turn (the stable prompt prefix) is kept in front.
+    """
+    system, rest = split_system(messages)
+    turns = []
+    for m in rest:
+        if turns and turns[-1]["role"] == m["role"]:
+            turns[-1] = {"role": m["role"], "content": f"{turns[-1]['content']}\n\n{m['content']}"}
+        else:
+            turns.append({"role": m["role"], "content": m["content"]})
+    while turns and turns[0]["role"] != "user":
+        turns.pop(0)
+    return ([{"role": "system", "content": system}] if system else []) + turns
+
+# Context packing - project files are ranked against the user message with
+# BM25 over an incrementally refreshed per-root index, and the best snippets
+# are packed into the prompt under a per-model token budget
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 4000))  # 0 disables
+CONTEXT_CHUNK_LINES = int(os.getenv("CONTEXT_CHUNK_LINES", 40))
+CONTEXT_MAX_FILE_BYTES = int(os.getenv("CONTEXT_MAX_FILE_BYTES", 256 * 1024))
+CONTEXT_MAX_FILES = int(os.getenv("CONTEXT_MAX_FILES", 5000))
+CONTEXT_INDEX_REFRESH = float(os.getenv("CONTEXT_INDEX_REFRESH", 10))  # Seconds between rescans
+CONTEXT_MAX_INDEXES = int(os.getenv("CONTEXT_MAX_INDEXES", 8))
+CONTEXT_IGNORE_DIRS = {"node_modules", "__pycache__", "venv", "dist", "build"}
+CONTEXT_IGNORE_FILES = {"package-lock.json", "yarn.lock", "pnpm-lock.yaml", "poetry.lock"}
+CONTEXT_MIN_SNIPPET_TOKENS = 32
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+def code_terms(text: str) -> List[str]:
+    """Lowercased identifier parts: get_file_tree and getFileTree both yield get, file, tree"""
+    terms = []
+    for identifier in re.findall(r"[A-Za-z0-9_]+", text):
+        parts = [p.lower() for p in re.findall(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+", identifier)]
+        terms.extend(p for p in parts if len(p) > 1 and p not in SEMANTIC_STOPWORDS)
+        if len(parts) > 1:
+            terms.append(identifier.lower())
+    return terms
+
+class ContextChunk:
+    """A run of lines from one file plus its term frequencies"""
+
+    __slots__ = ("path", "start", "end", "text", "terms", "length")
+
+    def __init__(self, path: str, start: int, end: int, text: str, terms: Dict[str, int]):
+        self.path = path
+        self.start = start
+        self.end = end
+        self.text = text
+        self.terms = terms
+        self.length = sum(terms.values())
+
+class WorkspaceIndex:
+    """BM25 index of one project root; only files whose mtime/size changed are re-read"""
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.files: Dict[str, tuple] = {}  # relative path -> (mtime_ns, size, chunk ids)
+        self.chunks: Dict[int, ContextChunk] = {}
+        self.postings: Dict[str, Dict[int, int]] = {}  # term -> chunk id -> term frequency
+        self.total_length = 0
+        self.next_chunk = 0
+        self.refreshed = 0.0
+        self.lock = threading.Lock()  # Guards the index structures; held only for in-memory work
+        self.refresh_lock = threading.Lock()  # One rescan at a time; others keep using the current index
+
+    def _walk(self):
+        count = 0
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if not d.startswith(".") and d not in CONTEXT_IGNORE_DIRS]
+            for name in filenames:
+                if name.startswith(".") or name in CONTEXT_IGNORE_FILES:
+                    continue
+                path = Path(dirpath) / name
+                try:
+                    stat = path.stat()
+                except OSError:
+                    continue
+                if stat.st_size > CONTEXT_MAX_FILE_BYTES:
+                    continue
+                yield path.relative_to(self.root).as_posix(), stat
+                count += 1
+                if count >= CONTEXT_MAX_FILES:
+                    return
+
+    def _remove_file(self, rel_path: str):
+        for chunk_id in self.files.pop(rel_path)[2]:
+            chunk = self.chunks.pop(chunk_id)
+            self.total_length -= chunk.length
+            for term in chunk.terms:
+                posting = self.postings[term]
+                del posting[chunk_id]
+                if not posting:
+                    del self.postings[term]
+
+    def _read_chunks(self, rel_path: str) -> List[ContextChunk]:
+        chunks = []
+        try:
+            data = (self.root / rel_path).read_bytes()
+            kind, encoding = sniff_bytes(data[:SNIFF_BYTES], len(data))
+            text = data.decode(encoding) if kind == "text" else None
+        except (OSError, UnicodeDecodeError):
+            text = None
+        if text:
+            path_terms = code_terms(rel_path)
+            lines = text.splitlines()
+            for start in range(0, len(lines), CONTEXT_CHUNK_LINES):
+                body = "\n".join(lines[start:start + CONTEXT_CHUNK_LINES])
+                if not body.strip():
+                    continue
+                terms: Dict[str, int] = {}
+                for term in code_terms(body) + path_terms:
+                    terms[term] = terms.get(term, 0) + 1
+                chunks.append(ContextChunk(rel_path, start + 1, min(start + CONTEXT_CHUNK_LINES, len(lines)), body, terms))
+        return chunks
+
+    def _add_file(self, rel_path: str, stat, chunks: List[ContextChunk]):
+        chunk_ids = []
+        for chunk in chunks:
+            chunk_id = self.next_chunk
+            self.next_chunk += 1
+            self.chunks[chunk_id] = chunk
+            self.total_length += chunk.length
+            for term, tf in chunk.terms.items():
+                self.postings.setdefault(term, {})[chunk_id] = tf
+            chunk_ids.append(chunk_id)
+        self.files[rel_path] = (stat.st_mtime_ns, stat.st_size, chunk_ids)
+
+    def refresh(self) -> bool:
+        """Rescan the tree; returns False at once if another thread is already rescanning"""
+        if not self.refresh_lock.acquire(blocking=False):
+            return False
+        try:
+            # Walk and read without self.lock so searches keep running; only
+            # this thread mutates the index, so reading self.files is safe
+            seen = set()
+            changed = []
+            for rel_path, stat in self._walk():
+                seen.add(rel_path)
+                known = self.files.get(rel_path)
+                if known and known[0] == stat.st_mtime_ns and known[1] == stat.st_size:
+                    continue
+                changed.append((rel_path, stat, self._read_chunks(rel_path)))
+            with self.lock:
+                for rel_path, stat, chunks in changed:
+                    if rel_path in self.files:
+                        self._remove_file(rel_path)
+                    self._add_file(rel_path, stat, chunks)
+                for rel_path in [p for p in self.files if p not in seen]:
+                    self._remove_file(rel_path)
+            self.refreshed = time.monotonic()
+            return True
+        finally:
+            self.refresh_lock.release()
+
+    def search(self, query: str, limit: int) -> List[tuple]:
+        """Top (chunk, score) pairs by BM25"""
+        if not self.chunks:
+            return []
+        count = len(self.chunks)
+        average_length = self.total_length / count or 1.0
+        scores: Dict[int, float] = {}
+        for term in set(code_terms(query)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (count - len(posting) + 0.5) / (len(posting) + 0.5))
+            for chunk_id, tf in posting.items():
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.chunks[chunk_id].length / average_length)
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+        best = heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+        return [(self.chunks[chunk_id], score) for chunk_id, score in best]
+
+    def pack(self, query: str, budget: int) -> tuple:
+        """Greedily fit the best-ranked snippets into budget tokens; returns (prompt text, snippet info)"""
+        if time.monotonic() - self.refreshed > CONTEXT_INDEX_REFRESH:
+            self.refresh()  # Serves the current (possibly stale) index if a rescan is already running
+        with self.lock:
+            ranked = self.search(query, limit=64)
+        sections = []
+        snippets = []
+        remaining = budget
+        for chunk, score in ranked:
+            section = f"--- {chunk.path} (lines {chunk.start}-{chunk.end}) ---\n{chunk.text}"
+            tokens = estimate_tokens(section)
+            if tokens > remaining:
+                continue
+            sections.append(section)
+            snippets.append({
+                "path": chunk.path,
+                "start_line": chunk.start,
+                "end_line": chunk.end,
+                "score": round(score, 3),
+                "tokens": tokens
+            })
+            remaining -= tokens
+            if remaining < CONTEXT_MIN_SNIPPET_TOKENS:
+                break
+        if not sections:
+            return "", []
+        return "Relevant project files:\n\n" + "\n\n".join(sections), snippets
+
+workspace_indexes: "OrderedDict[str, WorkspaceIndex]" = OrderedDict()
+session_project_roots: Dict[str, str] = {}
+session_registry.on_evict.append(lambda session_id: session_project_roots.pop(session_id, None))
+
+def resolve_project_root(project_root: str) -> str:
+    """Project roots follow the file-operation policy: under the working directory or /app"""
+    root = checked_path(project_root).resolve()
+    allowed = (Path.cwd().resolve(), Path("/app").resolve())
+    if not any(root == base or base in root.parents for base in allowed):
+        raise HTTPException(status_code=403, detail="Access denied")
+    if not root.is_dir():
+        raise HTTPException(status_code=400, detail=f"Project root not found: {project_root}")
+    return str(root)
+
+def get_workspace_index(root: str) -> WorkspaceIndex:
+    index = workspace_indexes.get(root)
+    if index is None:
+        index = workspace_indexes[root] = WorkspaceIndex(Path(root))
+        while len(workspace_indexes) > CONTEXT_MAX_INDEXES:
+            workspace_indexes.popitem(last=False)
+    workspace_indexes.move_to_end(root)
+    return index
+
+async def pack_project_context(request: ChatMessage) -> tuple:
+    """Relevant snippets of the session's project for this message, as (text, snippet info)"""
+    if request.project_root:
+        session_project_roots[request.session_id] = resolve_project_root(request.project_root)
+    root = session_project_roots.get(request.session_id)
+    budget = CONTEXT_TOKEN_BUDGET if request.context_budget is None else request.context_budget
+    # Leave at least half the window for the message, history and completion
+    budget = min(budget, context_window(request.model, request.provider) // 2 - request.max_tokens - estimate_tokens(request.message))
+    if not root or budget < CONTEXT_MIN_SNIPPET_TOKENS:
+        return "", []
+    return await run_io("context_index", get_workspace_index(root).pack, request.message, budget)
+
+# Session context - clients keep a per-session context dict on the server and
+# patch it with JSON merge patches (RFC 7386); the rendered prompt prefix is
+# cached until the state changes
+def merge_patch(target: Any, patch: Any) -> Any:
+    """Apply a JSON merge patch, copying only the dicts along patched paths"""
+    if not isinstance(patch, dict):
+        return patch
+    result = dict(target) if isinstance(target, dict) else {}
+    for key, value in patch.items():
+        if value is None:
+            result.pop(key, None)
+        else:
+            result[key] = merge_patch(result.get(key), value)
+    return result
+
+class SessionContext:
+    """Context state for one session and its cached 'Context: ...' prompt prefix"""
+
+    __slots__ = ("state", "version", "rendered")
+
+    def __init__(self):
+        self.state: Dict = {}
+        self.version = 0
+        self.rendered = ""
+
+    def nbytes(self) -> int:
+        # The state dict is roughly as large as its JSON rendering
+        return 2 * sys.getsizeof(self.rendered)
+
+    def update(self, context: Optional[Dict] = None, delta: Optional[Dict] = None, version: Optional[int] = None) -> int:
+        """Replace and/or patch the state; returns the change in memory held"""
+        if delta is not None and context is None and version is not None and version != self.version:
+            raise HTTPException(
+                status_code=409,
+                detail=f"Context version mismatch (server has {self.version}); resend the full context"
+            )
+        state = self.state if context is None else context
+        if delta is not None:
+            state = merge_patch(state, delta)
+        if state == self.state:
+            return 0
+        before = self.nbytes()
+        self.state = state
+        self.version += 1
+        self.rendered = f"Context: {json.dumps(state)}" if state else ""
+        return self.nbytes() - before
+
+session_contexts: Dict[str, SessionContext] = {}
+session_registry.on_evict.append(lambda session_id: session_contexts.pop(session_id, None))
+
+def update_session_context(session_id: str, context: Optional[Dict], delta: Optional[Dict], version: Optional[int]) -> tuple:
+    """Apply a client update; returns (session context or None, bytes added)"""
+    session_context = session_contexts.get(session_id)
+    if session_context is None:
+        if context is None and delta is None:
+            return None, 0
+        session_context = SessionContext()
+    added = session_context.update(context, delta, version)
+    session_contexts[session_id] = session_context
+    return session_context, added
+
+def context_version(session_id: str) -> int:
+    session_context = session_contexts.get(session_id)
+    return session_context.version if session_context else 0
+
+async def prepare_chat_message(request: ChatMessage) -> tuple:
+    """Record the user turn; return the context-aware prompt, the prior turns to send and the packed snippets.
+
+    Stable parts come first so providers can cache the prefix: the session
+    context as a system turn, then the summary and prior turns. Snippets
+    chosen for this message go in the final user turn.
+    """
+    session_id = request.session_id
+    session_history = await conversation_store.load(session_id)
+    
+    # Prepare context-aware message
+    session_context, context_bytes = update_session_context(
+        session_id, request.context, request.context_delta, request.context_version
+    )
+    project_context, snippets = await pack_project_context(request)
+    context_message = request.message
+    if project_context:
+        context_message = f"{project_context}\n\nUser message: {request.message}"
+    
+    # Turns already folded into the rolling summary are replaced by it
+    summary = conversation_summaries.get(session_id)
+    reserved = estimate_tokens(context_message) + request.max_tokens
+    recent = session_history
+    system = []
+    if session_context and session_context.rendered:
+        system = [{"role": "system", "content": session_context.rendered}]
+        reserved += estimate_tokens(session_context.rendered)
+    prefix = []
+    if summary:
+        recent = recent[summary_start(session_id, recent):]
+        reserved += summary["tokens"]
+        prefix = [{"role": "user", "content": f"Summary of the earlier conversation:\n{summary['summary']}"}]
+    budget = history_budget(request.model, request.provider, reserved)
+    history = system + (prefix + window_history(recent, budget) if budget else [])
+    
+    # Add user message to history
+    conversation_store.append(session_id, "user", request.message)
+    if context_bytes:
+        session_registry.touch(session_id, context_bytes)
+    
+    return context_message, history, snippets
+
+def record_ai_response(request: ChatMessage, ai_response: str):
+    """Add an assistant turn to the session history"""
+    conversation_store.append(request.session_id, "assistant", ai_response, request.model, request.provider)
+    schedule_summarization(request.session_id)
+
+# Background summarization - old turns of long sessions are compacted into a
+# rolling summary off the request path; the original turns are kept
+SUMMARY_TRIGGER_TOKENS = int(os.getenv("SUMMARY_TRIGGER_TOKENS", 6000))
+SUMMARY_KEEP_RECENT_TURNS = int(os.getenv("SUMMARY_KEEP_RECENT_TURNS", 6))
+SUMMARY_CHUNK_TOKENS = int(os.getenv("SUMMARY_CHUNK_TOKENS", 4000))
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", 500))
+SUMMARY_PROVIDER = os.getenv("SUMMARY_PROVIDER", "openai")
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "gpt-4o-mini")
+conversation_summaries = conversation_store.summaries
+summary_queue: Optional[asyncio.Queue] = None
+summary_pending = set()
+summary_stats = {"runs": 0, "failures": 0, "turns_summarized": 0}
+
+def summary_start(session_id: str, history: List[MessageRecord]) -> int:
+    """Index of the first turn the summary does not cover ('covered' is a message id)"""
+    covered = conversation_summaries.get(session_id, {}).get("covered", 0)
+    return bisect.bisect_right(history, covered, key=lambda entry: entry.id)
+
+def unsummarized_tokens(session_id: str, history: List[MessageRecord]) -> int:
+    return sum(entry_tokens(entry) for entry in history[summary_start(session_id, history):])
+
+def schedule_summarization(session_id: str):
+    """Queue a session for compaction once its unsummarized turns grow too large"""
+    history = conversation_store.cached(session_id)
+    if summary_queue is None or history is None or session_id in summary_pending:
+        return
+    if unsummarized_tokens(session_id, history) > SUMMARY_TRIGGER_TOKENS:
+        summary_pending.add(session_id)
+        summary_queue.put_nowait(session_id)
+
+async def summarize_session(session_id: str):
+    """Fold the oldest unsummarized turns (one bounded chunk per pass) into the summary"""
+    history = await conversation_store.load(session_id)
+    current = conversation_summaries.get(session_id, {"summary": "", "covered": 0})
+    start = summary_start(session_id, history)
+    end = start
+    chunk_tokens = 0
+    while end < len(history) - SUMMARY_KEEP_RECENT_TURNS and chunk_tokens < SUMMARY_CHUNK_TOKENS:
+        chunk_tokens += entry_tokens(history[end])
+        end += 1
+    if end == start:
+        return False
+    
+    transcript = "\n\n".join(f"{entry.role.upper()}: {entry.content}" for entry in history[start:end])
+    prompt = (
+        "Update the running summary of a conversation between a developer and an AI coding assistant.\n"
+        "Keep decisions, requirements, file names, code identifiers and open questions. Be concise.\n\n"
+        f"Current summary:\n{current['summary'] or '(none)'}\n\n"
+        f"New turns:\n{transcript}\n\n"
+        "Updated summary:"
+    )
+    summary = await chat_with_ai(prompt, SUMMARY_MODEL, SUMMARY_PROVIDER, temperature=0.2, max_tokens=SUMMARY_MAX_TOKENS, use_cache=False, semantic_cache_enabled=False)
+    await conversation_store.save_summary(session_id, {
+        "summary": summary,
+        "covered": history[end - 1].id,
+        "tokens": estimate_tokens(summary),
+        "updated": datetime.now().isoformat()
+    })
+    summary_stats["turns_summarized"] += end - start
+    return True
+
+async def summarization_worker():
+    """Drain the summary queue until each queued session is under the trigger"""
+    while True:
+        session_id = await summary_queue.get()
+        try:
+            while unsummarized_tokens(session_id, await conversation_store.load(session_id)) > SUMMARY_TRIGGER_TOKENS:
+                summary_stats["runs"] += 1
+                if not await summarize_session(session_id):
+                    break
+        except Exception as e:
+            summary_stats["failures"] += 1
+            logger.error(f"Summarization failed for session {session_id}: {str(e)}")
+        finally:
+            summary_pending.discard(session_id)
+
+def sse_event(data: Dict) -> str:
+    """Format a Server-Sent Events frame"""
+    return f"data: {json.dumps(data)}\n\n"
 
 @app.post("/api/chat")
 async def chat_endpoint(request: ChatMessage):
     """Enhanced chat endpoint with context awareness"""
     try:
         session_id = request.session_id
-        
-        # Initialize conversation history for session
-        if session_id not in conversation_history:
-            conversation_history[session_id] = []
-        
-        # Add user message to history
-        conversation_history[session_id].append({
-            "role": "user",
-            "content": request.message,
-            "timestamp": datetime.now().isoformat()
-        })
-        
-        # Prepare context-aware message
-        context_message = request.message
-        if request.context:
-            context_info = f"Context: {json.dumps(request.context)}\n\nUser message: {request.message}"
-            context_message = context_info
+        context_message, history, snippets = await prepare_chat_message(request)
+        usage = track_request_usage()
         
         # Get AI response
         ai_response = await chat_with_ai(
@@ -289,54 +2540,417 @@ async def chat_endpoint(request: ChatMessage):
             request.model,
             request.provider,
             request.temperature,
-            request.max_tokens
+            request.max_tokens,
+            request.cache,
+            request.hedge,
+            history=history,
+            semantic_cache_enabled=request.semantic_cache,
+            semantic_text=request.message
         )
         
         # Add AI response to history
-        conversation_history[session_id].append({
-            "role": "assistant",
-            "content": ai_response,
-            "timestamp": datetime.now().isoformat(),
-            "model": request.model,
-            "provider": request.provider
-        })
+        record_ai_response(request, ai_response)
         
         return {
             "response": ai_response,
             "session_id": session_id,
             "model": request.model,
-            "provider": request.provider
+            "provider": request.provider,
+            "context_snippets": snippets,
+            "context_version": context_version(session_id),
+            "usage": usage
         }
         
+    except HTTPException:
+        raise
+    except ProviderBusyError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    except CircuitOpenError as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         logger.error(f"Chat error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/chat/stream")
+async def chat_stream_endpoint(request: ChatMessage, http_request: Request):
+    """Stream chat tokens as Server-Sent Events"""
+    context_message, history, snippets = await prepare_chat_message(request)
+    
+    async def event_stream():
+        usage = track_request_usage()
+        tokens = stream_chat_with_ai(
+            context_message,
+            request.model,
+            request.provider,
+            request.temperature,
+            request.max_tokens,
+            request.cache,
+            request.hedge,
+            history=history
+        )
+        parts = []
+        try:
+            async for token in tokens:
+                if await http_request.is_disconnected():
+                    logger.info(f"Chat stream client disconnected: {request.session_id}")
+                    return
+                parts.append(token)
+                yield sse_event({"type": "token", "content": token})
+            
+            ai_response = "".join(parts)
+            record_ai_response(request, ai_response)
+            yield sse_event({
+                "type": "done",
+                "response": ai_response,
+                "session_id": request.session_id,
+                "model": request.model,
+                "provider": request.provider,
+                "context_snippets": snippets,
+                "context_version": context_version(request.session_id),
+                "usage": usage
+            })
+        except Exception as e:
+            logger.error(f"Chat stream error: {str(e)}")
+            yield sse_event({"type": "error", "message": str(e)})
+        finally:
+            # Stops the upstream request if we exit before it finished
+            await tokens.aclose()
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", 100))
+
+@app.post("/api/chat/batch")
+async def chat_batch_endpoint(request: BatchChatRequest):
+    """Run many chat prompts concurrently, streaming NDJSON results as they complete"""
+    if not request.items:
+        raise HTTPException(status_code=400, detail="At least one item is required")
+    if len(request.items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"Batch exceeds {BATCH_MAX_ITEMS} items")
+    
+    async def run_item(index: int, item: ChatMessage) -> Dict:
+        try:
+            context_message, history, snippets = await prepare_chat_message(item)
+            usage = track_request_usage()
+            ai_response = await chat_with_ai(
+                context_message,
+                item.model,
+                item.provider,
+                item.temperature,
+                item.max_tokens,
+                item.cache,
+                item.hedge,
+                history=history,
+                semantic_cache_enabled=item.semantic_cache,
+                semantic_text=item.message
+            )
+            record_ai_response(item, ai_response)
+            return {
+                "index": index,
+                "success": True,
+                "response": ai_response,
+                "session_id": item.session_id,
+                "model": item.model,
+                "provider": item.provider,
+                "context_snippets": snippets,
+                "context_version": context_version(item.session_id),
+                "usage": usage
+            }
+        except HTTPException as e:
+            return {"index": index, "success": False, "error": e.detail, "status": e.status_code}
+        except Exception as e:
+            logger.error(f"Batch chat item {index} error: {str(e)}")
+            status = 429 if isinstance(e, ProviderBusyError) else 503 if isinstance(e, CircuitOpenError) else 500
+            return {"index": index, "success": False, "error": str(e), "status": status}
+    
+    async def results():
+        # Provider limiters bound the real upstream concurrency
+        tasks = [asyncio.ensure_future(run_item(index, item)) for index, item in enumerate(request.items)]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield json.dumps(await next_done) + "\n"
+        finally:
+            await cancel_tasks([task for task in tasks if not task.done()])
+    
+    return StreamingResponse(results(), media_type="application/x-ndjson")
+
+def first_index_after(entries: List[MessageRecord], message_id: int) -> int:
+    """Index of the first entry whose id is greater than message_id (entries are sorted by id)"""
+    low, high = 0, len(entries)
+    while low < high:
+        mid = (low + high) // 2
+        if entries[mid].id <= message_id:
+            low = mid + 1
+        else:
+            high = mid
+    return low
+
 @app.get("/api/conversations/{session_id}")
-async def get_conversation_history(session_id: str):
-    """Get conversation history for a session"""
-    return conversation_history.get(session_id, [])
+async def get_conversation_history(
+    session_id: str,
+    request: Request,
+    before: Optional[int] = None,
+    after: Optional[int] = None,
+    since: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=1000)
+):
+    """Get conversation history for a session, optionally a page or a delta.
+
+    before/after are message ids (exclusive); since is an ISO timestamp.
+    With only limit, the newest messages are returned. Results are always
+    in chronological order; X-Has-More says whether the range continues.
+    """
+    entries = await conversation_store.load(session_id)
+    
+    start, end = 0, len(entries)
+    if after is not None:
+        start = first_index_after(entries, after)
+    if before is not None:
+        end = first_index_after(entries, before - 1)
+    if since is not None:
+        try:
+            since_time = datetime.fromisoformat(since)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="since must be an ISO timestamp")
+        since_ms = epoch_ms(since_time)
+        while start < end and entries[start].timestamp <= since_ms:
+            start += 1
+    
+    has_more = False
+    if limit is not None and end - start > limit:
+        has_more = True
+        if after is not None or since is not None:
+            end = start + limit  # Paging forward
+        else:
+            start = end - limit  # Paging backward from the newest / before
+    
+    # Histories are append-only, so the last id and length identify the content
+    last_id = entries[-1].id if entries else 0
+    etag = hashlib.sha1(f"{session_id}:{len(entries)}:{last_id}:{before}:{after}:{since}:{limit}".encode("utf-8")).hexdigest()
+    headers = {"ETag": f'W/"{etag}"', "Cache-Control": "no-cache", "X-Has-More": "true" if has_more else "false"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in if_none_match or if_none_match.strip() == "*":
+        return Response(status_code=304, headers=headers)
+    
+    return JSONResponse(content=[record.to_dict() for record in entries[start:end]], headers=headers)
+
+@app.get("/api/conversations/{session_id}/summary")
+async def get_conversation_summary(session_id: str):
+    """Get the rolling summary for a session and how many turns it covers"""
+    history = await conversation_store.load(session_id)
+    summary = conversation_summaries.get(session_id)
+    total = len(history)
+    if not summary:
+        return {"session_id": session_id, "summary": None, "covered": 0, "covered_turns": 0, "total": total}
+    return {**summary, "session_id": session_id, "covered_turns": summary_start(session_id, history), "total": total}
+
+@app.get("/api/conversations/{session_id}/context")
+async def get_session_context(session_id: str):
+    """Get the context state stored for a session"""
+    session_context = session_contexts.get(session_id)
+    if session_context is None:
+        return {"session_id": session_id, "context": {}, "version": 0}
+    return {"session_id": session_id, "context": session_context.state, "version": session_context.version}
+
+@app.patch("/api/conversations/{session_id}/context")
+async def update_context(session_id: str, request: ContextUpdate):
+    """Replace (context) and/or merge-patch (delta) a session's context state"""
+    session_context, added = update_session_context(session_id, request.context, request.delta, request.version)
+    if session_context is None:
+        return {"session_id": session_id, "context": {}, "version": 0}
+    session_registry.touch(session_id, added)
+    return {"session_id": session_id, "context": session_context.state, "version": session_context.version}
+
+# File I/O pool - blocking filesystem work runs on a dedicated, bounded
+# thread pool so large reads, deletes and tree walks never stall the event
+# loop; IO_MAX_PENDING caps queued jobs and each operation is timed
+IO_MAX_WORKERS = int(os.getenv("IO_MAX_WORKERS", 8))
+IO_MAX_PENDING = int(os.getenv("IO_MAX_PENDING", 64))
+FILE_OPERATIONS = ("read", "write", "create", "delete", "list")
+# Pool and semaphore are created on first use, inside the running loop, and
+# dropped at shutdown so the app can be started again in the same process
+io_executor: Optional[ThreadPoolExecutor] = None
+io_slots: Optional[asyncio.Semaphore] = None
+io_pending = 0
+
+class IOHistogram(LatencyHistogram):
+    """Latency histogram with sub-millisecond buckets for filesystem work"""
+
+    BOUNDS = [0.0001 * 1.5 ** i for i in range(32)]  # 0.1ms .. ~28s
+
+    def __init__(self, window: int = 500):
+        super().__init__(window)
+        self.errors = 0
+        self.max = 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        p50, p95, p99 = (self.percentile(p) for p in (50, 95, 99))
+        return {
+            "samples": self.samples,
+            "errors": self.errors,
+            "p50_ms": round(p50 * 1000, 2) if p50 else None,
+            "p95_ms": round(p95 * 1000, 2) if p95 else None,
+            "p99_ms": round(p99 * 1000, 2) if p99 else None,
+            "max_ms": round(self.max * 1000, 2)
+        }
+
+io_histograms: Dict[str, IOHistogram] = {}
+io_histograms_lock = threading.Lock()  # Recorded from pool threads
+
+def record_io(operation: str, seconds: float, failed: bool = False):
+    with io_histograms_lock:
+        histogram = io_histograms.get(operation)
+        if histogram is None:
+            histogram = io_histograms[operation] = IOHistogram()
+        histogram.record(seconds)
+        histogram.max = max(histogram.max, seconds)
+        if failed:
+            histogram.errors += 1
+
+async def run_io(operation: str, fn, *args):
+    """Run blocking filesystem work on the I/O pool, timing queue wait and run time"""
+    global io_executor, io_slots, io_pending
+    if io_executor is None:
+        io_executor = ThreadPoolExecutor(max_workers=IO_MAX_WORKERS, thread_name_prefix="file-io")
+        io_slots = asyncio.Semaphore(IO_MAX_PENDING)
+    executor, slots = io_executor, io_slots  # shutdown_io may swap them while we wait
+    queued = time.monotonic()
+    io_pending += 1
+    try:
+        async with slots:
+            return await asyncio.get_running_loop().run_in_executor(executor, timed_io, operation, queued, fn, args)
+    finally:
+        io_pending -= 1
+
+def shutdown_io():
+    """Release the I/O pool; the next run_io creates a fresh one"""
+    global io_executor, io_slots
+    if io_executor is not None:
+        io_executor.shutdown(wait=False)
+    io_executor = None
+    io_slots = None
+
+def timed_io(operation: str, queued: float, fn, args: tuple):
+    started = time.monotonic()
+    record_io("queue_wait", started - queued)
+    try:
+        result = fn(*args)
+    except BaseException:
+        record_io(operation, time.monotonic() - started, failed=True)
+        raise
+    record_io(operation, time.monotonic() - started)
+    return result
+
+def io_info() -> Dict[str, Any]:
+    return {
+        "max_workers": IO_MAX_WORKERS,
+        "max_pending": IO_MAX_PENDING,
+        "pending": io_pending,
+        "operations": {operation: histogram.stats() for operation, histogram in io_histograms.items()},
+        "sniff_cache": sniff_cache.stats()
+    }
+
+# File type sniffing - text vs binary and the likely encoding are decided from
+# the first few KB only, and cached per (device, inode, mtime, size)
+SNIFF_BYTES = int(os.getenv("SNIFF_BYTES", 4096))
+SNIFF_CACHE_SIZE = int(os.getenv("SNIFF_CACHE_SIZE", 20000))
+SNIFF_MAX_CONTROL_RATIO = 0.3
+TEXT_BOMS = [
+    (codecs.BOM_UTF32_LE, "utf-32"), (codecs.BOM_UTF32_BE, "utf-32"),  # Before UTF-16: the LE BOMs share a prefix
+    (codecs.BOM_UTF8, "utf-8-sig"), (codecs.BOM_UTF16_LE, "utf-16"), (codecs.BOM_UTF16_BE, "utf-16")
+]
+TEXT_CONTROL_BYTES = bytes([8, 9, 10, 12, 13, 27])  # Backspace, tab, newlines, form feed, escape
+
+def sniff_bytes(head: bytes, size: Optional[int] = None) -> tuple:
+    """(kind, encoding) for the start of a file of size bytes; kind is "text" or "binary" """
+    for bom, encoding in TEXT_BOMS:
+        if head.startswith(bom):
+            return "text", encoding
+    if b"\0" in head:
+        return "binary", None
+    if not head:
+        return "text", "utf-8"
+    control = len(head.translate(None, bytes(range(32, 256)) + TEXT_CONTROL_BYTES))
+    if control / len(head) > SNIFF_MAX_CONTROL_RATIO:
+        return "binary", None
+    try:
+        # Incremental so a multi-byte character cut off by the sample is not an
+        # error - unless the sample is the whole file, where it would fail the read
+        complete = len(head) >= size if size is not None else len(head) < SNIFF_BYTES
+        codecs.getincrementaldecoder("utf-8")().decode(head, final=complete)
+        return "text", "utf-8"
+    except UnicodeDecodeError:
+        return "text", "latin-1"
+
+class SniffCache:
+    """LRU of sniff results keyed by file identity and version"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self.lock = threading.Lock()  # Used from I/O pool threads
+        self.hits = 0
+        self.misses = 0
+
+    def sniff(self, path: Path, file_stat: Optional[os.stat_result] = None) -> tuple:
+        """(kind, encoding) for a regular file, reading at most SNIFF_BYTES on a miss"""
+        file_stat = file_stat or path.stat()
+        key = (file_stat.st_dev, file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size)
+        with self.lock:
+            result = self.entries.get(key)
+            if result is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return result
+            self.misses += 1
+        with open(path, "rb") as f:
+            result = sniff_bytes(f.read(SNIFF_BYTES), file_stat.st_size)
+        with self.lock:
+            self.entries[key] = result
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+sniff_cache = SniffCache(SNIFF_CACHE_SIZE)
+
+def checked_path(raw_path: str) -> Path:
+    """Security check - prevent access outside project directory"""
+    path = Path(raw_path)
+    if ".." in str(path) or str(path).startswith("/"):
+        if not str(path).startswith("/app"):
+            raise HTTPException(status_code=403, detail="Access denied")
+    return path
 
 @app.post("/api/file-operation")
 async def file_operation(request: FileOperation):
     """Enhanced file operations with safety checks"""
+    operation = request.operation if request.operation in FILE_OPERATIONS else "invalid"
+    return await run_io(f"file_operation.{operation}", perform_file_operation, request)
+
+def perform_file_operation(request: FileOperation) -> Dict[str, Any]:
+    """Run one file operation; blocking, so call it through run_io"""
     try:
-        path = Path(request.path)
-        
-        # Security check - prevent access outside project directory
-        if ".." in str(path) or str(path).startswith("/"):
-            if not str(path).startswith("/app"):
-                raise HTTPException(status_code=403, detail="Access denied")
+        path = checked_path(request.path)
         
         if request.operation == "read":
             if not path.exists():
                 raise HTTPException(status_code=404, detail="File not found")
             
             if path.is_file():
+                kind, encoding = sniff_cache.sniff(path)
+                if kind == "binary":
+                    return {"success": True, "content": "[Binary file - cannot display]", "type": "binary"}
                 try:
-                    with open(path, 'r', encoding='utf-8') as f:
+                    with open(path, 'r', encoding=encoding) as f:
                         content = f.read()
-                    return {"success": True, "content": content, "type": "file"}
+                    return {"success": True, "content": content, "type": "file", "encoding": encoding}
                 except UnicodeDecodeError:
                     # Handle binary files
                     return {"success": True, "content": "[Binary file - cannot display]", "type": "binary"}
@@ -417,6 +3031,299 @@ async def file_operation(request: FileOperation):
         logger.error(f"File operation error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# Batch file operations - operations on unrelated paths run in parallel on the
+# I/O pool, while operations on the same path (or a parent/child) keep their
+# order. Atomic batches stage content in temp files and apply every rename
+# or none of them
+FILE_BATCH_MAX_OPERATIONS = int(os.getenv("FILE_BATCH_MAX_OPERATIONS", 200))
+ATOMIC_FILE_OPERATIONS = ("write", "create", "delete")
+
+def path_parts(raw_path: str) -> tuple:
+    return Path(os.path.normpath(raw_path)).parts
+
+def paths_overlap(a: tuple, b: tuple) -> bool:
+    """Same path, or one contains the other"""
+    shared = min(len(a), len(b))
+    return a[:shared] == b[:shared]
+
+def operation_result(index: int, request: FileOperation, **fields) -> Dict[str, Any]:
+    return {"index": index, "operation": request.operation, "path": request.path, **fields}
+
+async def run_file_operations(operations: List[FileOperation]) -> List[Dict]:
+    """Run operations concurrently, each waiting only for earlier ones on overlapping paths"""
+    parts = [path_parts(request.path) for request in operations]
+    tasks: List[asyncio.Task] = []
+    
+    async def run(index: int, request: FileOperation, after: List[asyncio.Task]) -> Dict:
+        if after:
+            await asyncio.wait(after)
+        operation = request.operation if request.operation in FILE_OPERATIONS else "invalid"
+        try:
+            result = await run_io(f"file_operation.{operation}", perform_file_operation, request)
+        except HTTPException as e:
+            return operation_result(index, request, success=False, status=e.status_code, error=e.detail)
+        return operation_result(index, request, **result)
+    
+    for index, request in enumerate(operations):
+        after = [tasks[earlier] for earlier in range(index) if paths_overlap(parts[earlier], parts[index])]
+        tasks.append(asyncio.ensure_future(run(index, request, after)))
+    return list(await asyncio.gather(*tasks))
+
+class AtomicFileBatch:
+    """Stages new content next to each target, then applies all renames or rolls them back"""
+
+    def __init__(self, operations: List[FileOperation]):
+        self.operations = operations
+        self.paths = [checked_path(request.path) for request in operations]
+        self.staged: Dict[int, Path] = {}
+        self.created_dirs: List[Path] = []
+        self.undo: List[list] = []  # [path, backup or None, new file placed]
+        self.failed_index: Optional[int] = None
+
+    def prepare_dirs(self):
+        """Create missing parent directories up front, remembering them for rollback"""
+        for request, path in zip(self.operations, self.paths):
+            if request.operation == "delete":
+                continue
+            missing = []
+            parent = path.parent
+            while not parent.exists():
+                missing.append(parent)
+                parent = parent.parent
+            for directory in reversed(missing):
+                directory.mkdir(exist_ok=True)
+                self.created_dirs.append(directory)
+
+    def stage(self, index: int):
+        """Validate one operation and write its new content to a temp file (safe to run in parallel)"""
+        request, path = self.operations[index], self.paths[index]
+        try:
+            if request.operation == "delete":
+                if not path.exists():
+                    raise HTTPException(status_code=404, detail="File not found")
+                return
+            if request.operation == "create" and path.exists():
+                raise HTTPException(status_code=409, detail="File already exists")
+            if request.operation == "write" and request.content is None:
+                raise HTTPException(status_code=400, detail="Content required for write operation")
+            if path.is_dir():
+                raise HTTPException(status_code=400, detail="Path is a directory")
+            temp_path = partial_path(path)
+            with open(temp_path, "w", encoding="utf-8") as f:
+                f.write(request.content or "")
+            self.staged[index] = temp_path
+        except Exception:
+            self.failed_index = index if self.failed_index is None else min(self.failed_index, index)
+            raise
+
+    def commit(self):
+        """Swap everything into place in order; any failure undoes what was applied"""
+        for index, (request, path) in enumerate(zip(self.operations, self.paths)):
+            try:
+                if request.operation == "create" and path.exists():
+                    raise HTTPException(status_code=409, detail="File already exists")
+                step = [path, None, False]
+                self.undo.append(step)
+                if path.exists():
+                    step[1] = path.with_name(f".{path.name}.{uuid.uuid4().hex}.bak")
+                    os.replace(path, step[1])
+                if request.operation != "delete":
+                    os.replace(self.staged[index], path)
+                    del self.staged[index]
+                    step[2] = True
+            except Exception:
+                self.failed_index = index
+                self.rollback()
+                raise
+
+    def rollback(self):
+        for path, backup, placed in reversed(self.undo):
+            try:
+                if backup:
+                    os.replace(backup, path)
+                elif placed:
+                    path.unlink()
+            except OSError as e:
+                logger.error(f"Batch rollback failed for {path}: {str(e)}")
+        self.undo.clear()
+        remove_quietly(*self.staged.values())
+        self.staged.clear()
+        for directory in reversed(self.created_dirs):
+            try:
+                directory.rmdir()
+            except OSError:
+                pass
+
+    def cleanup(self):
+        """Drop the backups of replaced and deleted paths once the batch has committed"""
+        for _, backup, _ in self.undo:
+            if backup is None:
+                continue
+            try:
+                if backup.is_dir():
+                    shutil.rmtree(backup)
+                else:
+                    backup.unlink()
+            except OSError as e:
+                logger.warning(f"Could not remove batch backup {backup}: {str(e)}")
+
+async def run_atomic_file_operations(operations: List[FileOperation]) -> Dict[str, Any]:
+    parts = [path_parts(request.path) for request in operations]
+    for index, request in enumerate(operations):
+        if request.operation not in ATOMIC_FILE_OPERATIONS:
+            raise HTTPException(status_code=400, detail=f"Atomic batches support only {', '.join(ATOMIC_FILE_OPERATIONS)} (operation {index})")
+        if any(paths_overlap(parts[earlier], parts[index]) for earlier in range(index)):
+            raise HTTPException(status_code=400, detail=f"Atomic batches cannot touch a path twice or a path inside another (operation {index})")
+    batch = AtomicFileBatch(operations)
+    try:
+        await run_io("file_batch.prepare", batch.prepare_dirs)
+        staged = await asyncio.gather(
+            *(run_io("file_batch.stage", batch.stage, index) for index in range(len(operations))),
+            return_exceptions=True
+        )
+        error = next((e for e in staged if isinstance(e, BaseException)), None)
+        if error:
+            raise error
+        await run_io("file_batch.commit", batch.commit)
+    except Exception as e:
+        await run_io("file_batch.rollback", batch.rollback)
+        failed = batch.failed_index
+        status = e.status_code if isinstance(e, HTTPException) else 500
+        detail = e.detail if isinstance(e, HTTPException) else str(e)
+        results = [
+            operation_result(index, request, success=False, status=status, error=detail) if index == failed
+            else operation_result(index, request, success=False, status=424, error="Not applied; batch rolled back")
+            for index, request in enumerate(operations)
+        ]
+        return {"success": False, "atomic": True, "failed_index": failed, "results": results}
+    await run_io("file_batch.cleanup", batch.cleanup)
+    return {
+        "success": True,
+        "atomic": True,
+        "results": [operation_result(index, request, success=True) for index, request in enumerate(operations)]
+    }
+
+@app.post("/api/file-operations/batch")
+async def file_operations_batch(request: FileOperationBatch):
+    """Apply many file operations in one round trip, optionally all-or-nothing"""
+    if not request.operations:
+        raise HTTPException(status_code=400, detail="At least one operation is required")
+    if len(request.operations) > FILE_BATCH_MAX_OPERATIONS:
+        raise HTTPException(status_code=413, detail=f"Batch exceeds {FILE_BATCH_MAX_OPERATIONS} operations")
+    if request.atomic:
+        return await run_atomic_file_operations(request.operations)
+    results = await run_file_operations(request.operations)
+    return {"success": all(result["success"] for result in results), "atomic": False, "results": results}
+
+# Ranged file reads - large files are streamed in chunks (memory-mapped above
+# FILE_MMAP_THRESHOLD) so the server never holds a whole file in memory
+FILE_STREAM_CHUNK = int(os.getenv("FILE_STREAM_CHUNK", 256 * 1024))
+FILE_MMAP_THRESHOLD = int(os.getenv("FILE_MMAP_THRESHOLD", 8 * 1024 * 1024))
+
+def parse_range(header: str, size: int) -> Optional[tuple]:
+    """(start, end) inclusive for a single 'bytes=' range; None to send the whole file.
+
+    Raises ValueError when the range cannot be satisfied.
+    """
+    unit, _, spec = header.partition("=")
+    match = re.fullmatch(r"\s*(\d*)-(\d*)\s*", spec)
+    if unit.strip().lower() != "bytes" or not match or not any(match.groups()):
+        return None  # Malformed or multi-range headers may be ignored
+    first, last = match.groups()
+    if not first:
+        # Suffix range: the last N bytes
+        if int(last) == 0 or size == 0:
+            raise ValueError("range not satisfiable")
+        return max(0, size - int(last)), size - 1
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        raise ValueError("range not satisfiable")
+    return start, min(int(last), size - 1) if last else size - 1
+
+def open_file_source(path: Path, size: int) -> tuple:
+    """Open a file for ranged reads; returns (file, mmap or None)"""
+    handle = open(path, "rb")
+    if size < FILE_MMAP_THRESHOLD:
+        return handle, None
+    try:
+        view = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return handle, None
+    if hasattr(view, "madvise"):
+        view.madvise(mmap.MADV_SEQUENTIAL)
+    return handle, view
+
+def read_file_chunk(handle, view, offset: int, length: int) -> bytes:
+    if view is not None:
+        return view[offset:offset + length]
+    handle.seek(offset)
+    return handle.read(length)
+
+def close_file_source(handle, view):
+    if view is not None:
+        view.close()
+    handle.close()
+
+async def stream_file_range(path: Path, size: int, start: int, end: int) -> AsyncIterator[bytes]:
+    """Yield bytes start..end (inclusive), reading one chunk at a time on the I/O pool"""
+    handle, view = await run_io("file_content.open", open_file_source, path, size)
+    try:
+        offset = start
+        while offset <= end:
+            chunk = await run_io("file_content.read", read_file_chunk, handle, view, offset, min(FILE_STREAM_CHUNK, end - offset + 1))
+            if not chunk:
+                break  # File shrank while streaming
+            offset += len(chunk)
+            yield chunk
+    finally:
+        await run_io("file_content.close", close_file_source, handle, view)
+
+@app.get("/api/files/content")
+async def get_file_content(path: str, request: Request):
+    """Stream a file's bytes, honouring single-range Range requests"""
+    file_path = checked_path(path)
+    try:
+        file_stat = await run_io("file_content.stat", file_path.stat)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="File not found")
+    if not S_ISREG(file_stat.st_mode):
+        raise HTTPException(status_code=400, detail="Path is not a file")
+    
+    size = file_stat.st_size
+    etag = f'"{file_stat.st_mtime_ns:x}-{size:x}"'
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Last-Modified": formatdate(file_stat.st_mtime, usegmt=True),
+        "Cache-Control": "no-cache"
+    }
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    
+    byte_range = None
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (if_range is None or if_range == etag):
+        try:
+            byte_range = parse_range(range_header, size)
+        except ValueError:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+    
+    status = 200
+    start, end = 0, size - 1
+    if byte_range:
+        start, end = byte_range
+        status = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1 if size else 0)
+    media_type = mimetypes.guess_type(file_path.name)[0]
+    if media_type is None:
+        kind, encoding = await run_io("file_content.sniff", sniff_cache.sniff, file_path, file_stat)
+        media_type = f"text/plain; charset={encoding}" if kind == "text" else "application/octet-stream"
+    return StreamingResponse(stream_file_range(file_path, size, start, end), status_code=status, media_type=media_type, headers=headers)
+
 @app.get("/api/file-tree")
 async def get_file_tree():
     """Get project file tree structure"""
@@ -438,7 +3345,12 @@ async def get_file_tree():
                         "type": "directory" if item.is_dir() else "file"
                     }
                     
-                    if item.is_dir():
+                    if item.is_file():
+                        try:
+                            item_data["kind"], item_data["encoding"] = sniff_cache.sniff(item)
+                        except OSError:
+                            pass
+                    elif item.is_dir():
                         children = build_tree(item, max_depth, current_depth + 1)
                         if children:
                             item_data["children"] = children
@@ -449,7 +3361,7 @@ async def get_file_tree():
             
             return items
         
-        tree = build_tree(Path("."))
+        tree = await run_io("file_tree", build_tree, Path("."))
         return {"success": True, "tree": tree}
     
     except Exception as e:
@@ -497,6 +3409,10 @@ async def execute_command(request: CommandExecution):
 @app.post("/api/analyze-project")
 async def analyze_project(request: ProjectAnalysis):
     """Advanced project analysis"""
+    return await run_io("analyze_project", build_project_analysis, request)
+
+def build_project_analysis(request: ProjectAnalysis) -> Dict[str, Any]:
+    """Walk the project and summarise its structure; blocking, so call it through run_io"""
     try:
         project_path = Path(request.project_path)
         if not project_path.exists():
@@ -559,28 +3475,30 @@ async def analyze_project(request: ProjectAnalysis):
 async def generate_code(request: CodeGeneration):
     """AI-powered code generation"""
     try:
-        # Enhanced prompt for code generation
-        enhanced_prompt = f"""
-        Generate {request.language} code for the following request:
-        {request.prompt}
-        
-        Requirements:
-        - Language: {request.language}
-        - Framework: {request.framework or 'None specified'}
-        - Style: {request.style}
-        - Include proper error handling
-        - Add helpful comments
-        - Follow best practices
-        
-        Please provide clean, production-ready code.
-        """
+        # Instructions are the same for every request with these settings, so
+        # they go in the system turn where providers can cache them
+        instructions = f"""Generate {request.language} code for the user's request.
+
+Requirements:
+- Language: {request.language}
+- Framework: {request.framework or 'None specified'}
+- Style: {request.style}
+- Include proper error handling
+- Add helpful comments
+- Follow best practices
+
+Please provide clean, production-ready code."""
         
         # Use OpenAI for code generation
+        usage = track_request_usage()
         response = await chat_with_ai(
-            enhanced_prompt,
+            request.prompt,
             "gpt-4o",
             "openai",
-            temperature=0.3  # Lower temperature for more consistent code
+            temperature=0.3,  # Lower temperature for more consistent code
+            use_cache=request.cache,
+            history=[{"role": "system", "content": instructions}],
+            semantic_cache_enabled=request.semantic_cache
         )
         
         return {
@@ -588,7 +3506,8 @@ async def generate_code(request: CodeGeneration):
             "generated_code": response,
             "language": request.language,
             "framework": request.framework,
-            "prompt": request.prompt
+            "prompt": request.prompt,
+            "usage": usage
         }
     
     except Exception as e:
@@ -655,12 +3574,135 @@ async def terminal_websocket(websocket: WebSocket):
                     }))
     
     except WebSocketDisconnect:
-        if session_id in active_sessions:
-            del active_sessions[session_id]
+        pass
     except Exception as e:
         logger.error(f"Terminal WebSocket error: {str(e)}")
-        if session_id in active_sessions:
-            del active_sessions[session_id]
+    finally:
+        active_sessions.pop(session_id, None)
+
+@app.websocket("/api/chat/ws")
+async def chat_websocket(websocket: WebSocket):
+    """WebSocket endpoint carrying many concurrent, cancellable chat turns"""
+    await websocket.accept()
+    turns: Dict[str, asyncio.Task] = {}
+    send_lock = asyncio.Lock()
+    
+    async def send(payload: Dict):
+        async with send_lock:
+            await websocket.send_text(json.dumps(payload))
+    
+    async def run_turn(request_id: str, request: ChatMessage):
+        parts = []
+        try:
+            context_message, history, snippets = await prepare_chat_message(request)
+            usage = track_request_usage()
+            async for token in stream_chat_with_ai(
+                context_message,
+                request.model,
+                request.provider,
+                request.temperature,
+                request.max_tokens,
+                request.cache,
+                request.hedge,
+                history=history
+            ):
+                parts.append(token)
+                await send({"type": "token", "request_id": request_id, "content": token})
+            
+            ai_response = "".join(parts)
+            record_ai_response(request, ai_response)
+            await send({
+                "type": "done",
+                "request_id": request_id,
+                "response": ai_response,
+                "session_id": request.session_id,
+                "model": request.model,
+                "provider": request.provider,
+                "context_snippets": snippets,
+                "context_version": context_version(request.session_id),
+                "usage": usage
+            })
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Chat WebSocket turn error: {str(e)}")
+            await send({"type": "error", "request_id": request_id, "message": str(e)})
+        finally:
+            turns.pop(request_id, None)
+    
+    try:
+        await send({"type": "connection", "message": "Chat session started"})
+        
+        while True:
+            data = await websocket.receive_text()
+            try:
+                message = json.loads(data)
+            except json.JSONDecodeError:
+                await send({"type": "error", "message": "Invalid JSON"})
+                continue
+            
+            request_id = str(message.get("request_id") or uuid.uuid4())
+            
+            if message.get("type") == "chat":
+                if request_id in turns:
+                    await send({"type": "error", "request_id": request_id, "message": "Duplicate request_id"})
+                    continue
+                try:
+                    request = ChatMessage(**{k: v for k, v in message.items() if k not in ("type", "request_id")})
+                except Exception as e:
+                    await send({"type": "error", "request_id": request_id, "message": str(e)})
+                    continue
+                turns[request_id] = asyncio.create_task(run_turn(request_id, request))
+            
+            elif message.get("type") == "cancel":
+                task = turns.pop(request_id, None)
+                if task:
+                    task.cancel()
+                await send({"type": "cancelled", "request_id": request_id})
+            
+            else:
+                await send({"type": "error", "request_id": request_id, "message": "Invalid message type"})
+    
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        logger.error(f"Chat WebSocket error: {str(e)}")
+    finally:
+        for task in turns.values():
+            task.cancel()
+
+# Uploads - bodies are streamed to a temporary file in UPLOAD_CHUNK pieces and
+# renamed into place, so no upload is ever held in memory. Large uploads can
+# use the resumable protocol: init, PUT chunks at an offset, finalize with a
+# SHA-256. State lives on disk in UPLOAD_DIR, so uploads survive restarts
+UPLOAD_CHUNK = int(os.getenv("UPLOAD_CHUNK", 1024 * 1024))
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", 0))  # 0 = unlimited
+UPLOAD_DIR = Path(os.getenv("UPLOAD_DIR", ".uploads"))
+UPLOAD_TTL = float(os.getenv("UPLOAD_TTL", 86400))  # Unfinished uploads older than this are removed
+busy_uploads = set()  # Upload ids with a chunk, finalize or abort in progress
+
+def partial_path(destination: Path) -> Path:
+    return destination.with_name(f".{destination.name}.{uuid.uuid4().hex}.part")
+
+def open_for_write(path: Path, offset: int = 0):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    handle = open(path, "r+b" if offset else "wb")
+    handle.seek(offset)
+    return handle
+
+def move_into_place(source: Path, destination: Path):
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.replace(source, destination)
+    except OSError:
+        shutil.move(str(source), str(destination))  # Different filesystem
+
+def remove_quietly(*paths: Path):
+    for path in paths:
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
 
 @app.post("/api/upload-file")
 async def upload_file(file: UploadFile = File(...), path: str = ""):
@@ -672,25 +3714,165 @@ async def upload_file(file: UploadFile = File(...), path: str = ""):
         if ".." in str(upload_path):
             raise HTTPException(status_code=403, detail="Invalid file path")
         
-        # Create directory if it doesn't exist
-        upload_path.parent.mkdir(parents=True, exist_ok=True)
-        
-        # Save file
-        with open(upload_path, "wb") as buffer:
-            content = await file.read()
-            buffer.write(content)
+        temp_path = partial_path(upload_path)
+        handle = await run_io("upload_file.open", open_for_write, temp_path)
+        size = 0
+        try:
+            while True:
+                chunk = await file.read(UPLOAD_CHUNK)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if UPLOAD_MAX_BYTES and size > UPLOAD_MAX_BYTES:
+                    raise HTTPException(status_code=413, detail=f"Upload exceeds {UPLOAD_MAX_BYTES} bytes")
+                await run_io("upload_file.write", handle.write, chunk)
+            await run_io("upload_file.close", handle.close)
+            await run_io("upload_file.rename", move_into_place, temp_path, upload_path)
+        except BaseException:
+            await run_io("upload_file.close", handle.close)
+            await run_io("upload_file.cleanup", remove_quietly, temp_path)
+            raise
         
         return {
             "success": True,
             "message": f"File {file.filename} uploaded successfully",
             "path": str(upload_path),
-            "size": len(content)
+            "size": size
         }
     
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"File upload error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def upload_files(upload_id: str) -> tuple:
+    """(metadata path, data path) for an upload id, rejecting anything that is not one of ours"""
+    if not re.fullmatch(r"[0-9a-f]{32}", upload_id):
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return UPLOAD_DIR / f"{upload_id}.json", UPLOAD_DIR / f"{upload_id}.part"
+
+def load_upload(upload_id: str) -> Dict[str, Any]:
+    """Upload metadata plus the current offset (bytes on disk)"""
+    meta_path, data_path = upload_files(upload_id)
+    try:
+        meta = json.loads(meta_path.read_text())
+        offset = data_path.stat().st_size
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return {**meta, "upload_id": upload_id, "offset": offset}
+
+def create_upload(request: UploadInit) -> Dict[str, Any]:
+    UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    cutoff = time.time() - UPLOAD_TTL
+    busy = set(busy_uploads)
+    for meta_path in UPLOAD_DIR.glob("*.json"):
+        if meta_path.stem in busy:
+            continue
+        data_path = meta_path.with_suffix(".part")
+        try:
+            # Every chunk appends to the .part file, so its mtime is the last activity
+            last_active = data_path.stat().st_mtime if data_path.exists() else meta_path.stat().st_mtime
+            if last_active < cutoff:
+                remove_quietly(meta_path, data_path)
+        except OSError:
+            pass
+    upload_id = uuid.uuid4().hex
+    meta = {"path": request.path, "size": request.size, "sha256": request.sha256, "created": datetime.now().isoformat()}
+    meta_path, data_path = upload_files(upload_id)
+    data_path.touch()
+    meta_path.write_text(json.dumps(meta))
+    return {**meta, "upload_id": upload_id, "offset": 0}
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(UPLOAD_CHUNK), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+@asynccontextmanager
+async def exclusive_upload(upload_id: str):
+    """One request at a time per upload; a concurrent one gets 409"""
+    if upload_id in busy_uploads:
+        raise HTTPException(status_code=409, detail="Upload is busy with another request")
+    busy_uploads.add(upload_id)
+    try:
+        yield
+    finally:
+        busy_uploads.discard(upload_id)
+
+@app.post("/api/uploads")
+async def init_upload(request: UploadInit):
+    """Start a resumable upload"""
+    checked_path(request.path)
+    if request.size < 0:
+        raise HTTPException(status_code=400, detail="Size must not be negative")
+    if UPLOAD_MAX_BYTES and request.size > UPLOAD_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f"Upload exceeds {UPLOAD_MAX_BYTES} bytes")
+    upload = await run_io("upload.init", create_upload, request)
+    return {**upload, "chunk_size": UPLOAD_CHUNK}
+
+@app.get("/api/uploads/{upload_id}")
+async def get_upload(upload_id: str):
+    """Upload status; offset is where the next chunk must start"""
+    return await run_io("upload.status", load_upload, upload_id)
+
+@app.put("/api/uploads/{upload_id}")
+async def put_upload_chunk(upload_id: str, offset: int, request: Request):
+    """Append the request body at offset; the body is streamed to disk as it arrives"""
+    async with exclusive_upload(upload_id):
+        upload = await run_io("upload.status", load_upload, upload_id)
+        if offset != upload["offset"]:
+            raise HTTPException(status_code=409, detail={"message": "Offset does not match bytes received", "offset": upload["offset"]})
+        _, data_path = upload_files(upload_id)
+        handle = await run_io("upload.open", open_for_write, data_path, offset)
+        buffer = bytearray()
+        try:
+            async for data in request.stream():
+                buffer += data
+                if offset + len(buffer) > upload["size"]:
+                    raise HTTPException(status_code=400, detail="Chunk extends past the declared upload size")
+                if len(buffer) >= UPLOAD_CHUNK:
+                    await run_io("upload.write", handle.write, bytes(buffer))
+                    offset += len(buffer)
+                    buffer.clear()
+            if buffer:
+                await run_io("upload.write", handle.write, bytes(buffer))
+                offset += len(buffer)
+        finally:
+            # Whatever arrived before a disconnect is kept; the client resumes from there
+            await run_io("upload.close", handle.close)
+    return {"upload_id": upload_id, "offset": offset, "size": upload["size"]}
+
+@app.post("/api/uploads/{upload_id}/finalize")
+async def finalize_upload(upload_id: str, request: UploadFinalize):
+    """Verify size and SHA-256, then move the upload to its destination"""
+    async with exclusive_upload(upload_id):
+        upload = await run_io("upload.status", load_upload, upload_id)
+        expected = (request.sha256 or upload.get("sha256") or "").lower()
+        if not expected:
+            raise HTTPException(status_code=400, detail="sha256 is required")
+        if upload["offset"] != upload["size"]:
+            raise HTTPException(status_code=409, detail={"message": "Upload is incomplete", "offset": upload["offset"]})
+        meta_path, data_path = upload_files(upload_id)
+        actual = await run_io("upload.checksum", file_sha256, data_path)
+        if actual != expected:
+            await run_io("upload.cleanup", remove_quietly, meta_path, data_path)
+            raise HTTPException(status_code=422, detail="Checksum mismatch; upload discarded")
+        destination = checked_path(upload["path"])
+        await run_io("upload.rename", move_into_place, data_path, destination)
+        await run_io("upload.cleanup", remove_quietly, meta_path)
+    return {"success": True, "path": str(destination), "size": upload["size"], "sha256": actual}
+
+@app.delete("/api/uploads/{upload_id}")
+async def abort_upload(upload_id: str):
+    """Discard an unfinished upload"""
+    async with exclusive_upload(upload_id):
+        await run_io("upload.status", load_upload, upload_id)
+        await run_io("upload.cleanup", remove_quietly, *upload_files(upload_id))
+    return {"success": True, "upload_id": upload_id}
+
 @app.get("/api/health")
 async def health_check():
     """Health check endpoint"""
@@ -699,6 +3881,29 @@ async def health_check():
         "timestamp": datetime.now().isoformat(),
         "version": "2.0.0",
         "active_sessions": len(active_sessions),
+        "response_cache": response_cache.stats(),
+        "semantic_cache": semantic_cache.stats(),
+        "single_flight": {
+            **single_flight_stats,
+            "in_flight": len(inflight_requests) + len(inflight_streams)
+        },
+        "rate_limits": {
+            f"{provider}:{key_id}": limiter.stats()
+            for (provider, key_id), limiter in provider_limiters.items()
+        },
+        "latency": {
+            f"{provider}:{model}:{kind}": histogram.stats()
+            for (provider, model, kind), histogram in latency_histograms.items()
+        },
+        "hedging": hedge_stats,
+        "emergent_router": emergent_router.stats(),
+        "prompt_cache": prompt_cache_info(),
+        "circuit_breakers": {provider: breaker.stats() for provider, breaker in circuit_breakers.items()},
+        "retries": retry_stats,
+        "sessions": {**session_registry.info(), "contexts": len(session_contexts)},
+        "file_io": io_info(),
+        "conversation_store": conversation_store.info(),
+        "summarization": {**summary_stats, "queued": len(summary_pending), "sessions": len(conversation_summaries)},
         "providers": {
             "openai": bool(api_keys.get("openai")),
             "anthropic": bool(api_keys.get("anthropic")),
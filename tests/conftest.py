@@ -0,0 +1,5 @@
+import os
+import sys
+
+os.environ["DATABASE_URL"] = ""
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
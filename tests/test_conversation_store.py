@@ -0,0 +1,162 @@
+import asyncio
+import sqlite3
+import time
+
+import pytest
+
+import server
+
+
+def make_store(tmp_path):
+    return server.ConversationStore(str(tmp_path / "conversations.db"), flush_interval=60, batch_size=100)
+
+
+def test_load_keeps_appends_flushed_during_read(tmp_path):
+    async def scenario():
+        store = make_store(tmp_path)
+        await store.start()
+        try:
+            read = store._read
+
+            def slow_read(*args):
+                time.sleep(0.05)  # Let the flush queue its write behind this read
+                return read(*args)
+
+            store._read = slow_read
+            appended = [store.append("race", "user", f"message {i}") for i in range(3)]
+            entries, _ = await asyncio.gather(store.load("race"), store.flush())
+            assert [record.id for record in entries] == [record.id for record in appended]
+        finally:
+            await store.stop()
+
+    asyncio.run(scenario())
+
+
+def test_load_reads_back_persisted_session(tmp_path):
+    async def scenario():
+        store = make_store(tmp_path)
+        await store.start()
+        store.append("saved", "user", "hello")
+        store.append("saved", "assistant", "hi")
+        await store.save_summary("saved", {"summary": "greeting", "covered": 2, "tokens": 1, "updated": "now"})
+        await store.stop()
+
+        reopened = make_store(tmp_path)
+        await reopened.start()
+        try:
+            entries = await reopened.load("saved")
+            assert [record.content for record in entries] == ["hello", "hi"]
+            assert reopened.summaries["saved"]["summary"] == "greeting"
+        finally:
+            await reopened.stop()
+
+    asyncio.run(scenario())
+
+
+def test_workers_get_distinct_id_bits(tmp_path):
+    async def scenario():
+        first, second = make_store(tmp_path), make_store(tmp_path)
+        await first.start()
+        await second.start()
+        try:
+            assert first.worker_bits != second.worker_bits
+            ids = [first.next_id() for _ in range(5)] + [second.next_id() for _ in range(5)]
+            assert len(set(ids)) == len(ids)
+            assert all(message_id < 2 ** 53 for message_id in ids)
+        finally:
+            await first.stop()
+            await second.stop()
+
+    asyncio.run(scenario())
+
+
+def count_rows(tmp_path) -> int:
+    conn = sqlite3.connect(str(tmp_path / "conversations.db"))
+    try:
+        return conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_colliding_id_does_not_block_the_queue(tmp_path):
+    async def scenario():
+        store = make_store(tmp_path)
+        await store.start()
+        original = store.append("owner", "user", "first")
+        await store.flush()
+        intruder = server.MessageRecord(original.id, "user", "second", server.epoch_ms())
+        store.pending.append(("other", intruder))
+        later = [store.append("owner", "assistant", f"reply {i}") for i in range(5)]
+        await store.flush()
+        assert not store.pending
+        assert intruder.id == original.id + 1
+        await store.stop()
+
+        reopened = make_store(tmp_path)
+        await reopened.start()
+        try:
+            assert [record.content for record in await reopened.load("owner")] == ["first"] + [r.content for r in later]
+            assert [record.content for record in await reopened.load("other")] == ["second"]
+        finally:
+            await reopened.stop()
+
+    asyncio.run(scenario())
+
+
+def test_stop_during_write_does_not_duplicate_rows(tmp_path):
+    async def scenario():
+        store = make_store(tmp_path)
+        await store.start()
+        write = store._write
+
+        def slow_write(batch):
+            time.sleep(0.1)
+            return write(batch)
+
+        store._write = slow_write
+        for i in range(3):
+            store.append("stopping", "user", f"message {i}")
+        store.flush_event.set()
+        await asyncio.sleep(0.02)  # Writer is now inside the executor write
+        assert store.write_job is not None
+        await store.stop()
+        assert not store.pending and not store.flushing
+        assert store.stats["rows_written"] == 3
+
+    asyncio.run(scenario())
+    assert count_rows(tmp_path) == 3
+
+
+def test_cached_session_sees_other_workers_turns(tmp_path):
+    async def scenario():
+        first, second = make_store(tmp_path), make_store(tmp_path)
+        await first.start()
+        await second.start()
+        try:
+            first.append("shared", "user", "turn 1")
+            await first.flush()
+            assert [record.content for record in await first.load("shared")] == ["turn 1"]
+
+            await second.load("shared")
+            second.append("shared", "assistant", "turn 2")
+            await second.flush()
+            await second.save_summary("shared", {
+                "summary": "turn 1 happened", "covered": (await second.load("shared"))[0].id,
+                "tokens": 3, "updated": "now"
+            })
+
+            entries = await first.load("shared")
+            assert [record.content for record in entries] == ["turn 1", "turn 2"]
+            assert first.summaries["shared"]["summary"] == "turn 1 happened"
+            assert first.stats["cache_hits"] == 1
+        finally:
+            await first.stop()
+            await second.stop()
+
+    asyncio.run(scenario())
+
+
+def test_legacy_summary_turn_count_becomes_message_id():
+    entries = [server.MessageRecord(1000 + i, "user", f"turn {i}", server.epoch_ms()) for i in range(4)]
+    summary = server.ConversationStore._upgrade_summary({"summary": "s", "covered": 2, "tokens": 1, "updated": "now"}, entries)
+    assert summary["covered"] == entries[1].id
@@ -0,0 +1,73 @@
+import asyncio
+import os
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "a.txt").write_text("old a")
+    (tmp_path / "b.txt").write_text("old b")
+    return tmp_path
+
+
+def run_batch(*operations):
+    return asyncio.run(server.run_atomic_file_operations([server.FileOperation(**op) for op in operations]))
+
+
+def leftovers(root):
+    return sorted(path.name for path in root.rglob(".*") if path.name.endswith((".bak", ".part")))
+
+
+def test_failed_commit_restores_replaced_and_deleted_files(workspace, monkeypatch):
+    replace = os.replace
+
+    def failing_replace(src, dst):
+        if str(dst).endswith("c.txt"):
+            raise OSError("disk full")
+        return replace(src, dst)
+
+    monkeypatch.setattr(os, "replace", failing_replace)
+    result = run_batch(
+        {"operation": "write", "path": "a.txt", "content": "new a"},
+        {"operation": "delete", "path": "b.txt"},
+        {"operation": "write", "path": "c.txt", "content": "new c"}
+    )
+    assert not result["success"]
+    assert result["failed_index"] == 2
+    assert [r["status"] for r in result["results"]] == [424, 424, 500]
+    assert (workspace / "a.txt").read_text() == "old a"
+    assert (workspace / "b.txt").read_text() == "old b"
+    assert not (workspace / "c.txt").exists()
+    assert leftovers(workspace) == []
+
+
+def test_failed_staging_removes_temp_files_and_new_directories(workspace):
+    (workspace / "folder").mkdir()
+    result = run_batch(
+        {"operation": "write", "path": "new/nested/x.txt", "content": "x"},
+        {"operation": "write", "path": "a.txt", "content": "new a"},
+        {"operation": "write", "path": "folder", "content": "not a file"}
+    )
+    assert not result["success"]
+    assert result["failed_index"] == 2
+    assert result["results"][2]["status"] == 400
+    assert not (workspace / "new").exists()
+    assert (workspace / "a.txt").read_text() == "old a"
+    assert leftovers(workspace) == []
+
+
+def test_successful_batch_removes_backups(workspace):
+    result = run_batch(
+        {"operation": "write", "path": "a.txt", "content": "new a"},
+        {"operation": "delete", "path": "b.txt"},
+        {"operation": "create", "path": "dir/c.txt", "content": "c"}
+    )
+    assert result["success"]
+    assert (workspace / "a.txt").read_text() == "new a"
+    assert not (workspace / "b.txt").exists()
+    assert (workspace / "dir" / "c.txt").read_text() == "c"
+    assert leftovers(workspace) == []
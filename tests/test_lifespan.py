@@ -0,0 +1,28 @@
+import asyncio
+
+from fastapi.testclient import TestClient
+
+import server
+
+
+def test_app_restarts_in_the_same_process(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "notes.txt").write_text("hello")
+    for _ in range(2):
+        with TestClient(server.app) as client:
+            response = client.post("/api/file-operation", json={"operation": "read", "path": "notes.txt"})
+            assert response.status_code == 200
+            assert response.json()["content"] == "hello"
+    assert server.io_executor is None
+
+
+def test_conversation_store_releases_its_thread(tmp_path):
+    async def scenario():
+        store = server.ConversationStore(str(tmp_path / "conversations.db"), flush_interval=60, batch_size=100)
+        for _ in range(2):
+            await store.start()
+            store.append("restart", "user", "hello")
+            await store.stop()
+            assert store.executor is None
+
+    asyncio.run(scenario())
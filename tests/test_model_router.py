@@ -0,0 +1,24 @@
+import server
+
+
+def make_router():
+    return server.ModelRouter(["gpt-4o", "gpt-4o-mini"])
+
+
+def test_tried_and_untried_backends_compare_in_the_same_units():
+    router = make_router()
+    pricey, cheap = ("openai", "gpt-4o"), ("openai", "gpt-4o-mini")
+    router.record_success(pricey, latency=1.0, tokens=3000)
+    router.backends[cheap].latency = 1.0
+    # Equal latency and errors: the cheaper model must win whichever one has been tried
+    assert router.score(cheap) < router.score(pricey)
+    cost = router.score(pricey) - router.score(cheap)
+    expected = (server.MODEL_COSTS["gpt-4o"] - server.MODEL_COSTS["gpt-4o-mini"]) * router.expected_tokens / 1000
+    assert abs(cost - expected * router.cost_weight) < 1e-9
+
+
+def test_expected_tokens_follow_traffic():
+    router = make_router()
+    for _ in range(50):
+        router.record_success(("openai", "gpt-4o-mini"), latency=0.5, tokens=200)
+    assert abs(router.expected_tokens - 200) < 1
@@ -0,0 +1,30 @@
+import pytest
+
+import server
+
+
+@pytest.mark.parametrize("header, size, expected", [
+    ("bytes=0-", 10, (0, 9)),
+    ("bytes=2-5", 10, (2, 5)),
+    ("bytes=5-100", 10, (5, 9)),  # End past EOF is clamped
+    ("bytes=-3", 10, (7, 9)),  # Suffix: last 3 bytes
+    ("bytes=-20", 10, (0, 9)),  # Suffix longer than the file
+    ("bytes=5-2", 10, None),  # start > end: ignored, whole file
+    ("bytes=0-1,4-5", 10, None),  # Multi-range: ignored
+    ("items=0-1", 10, None),
+    ("bytes=-", 10, None),
+])
+def test_parse_range(header, size, expected):
+    assert server.parse_range(header, size) == expected
+
+
+@pytest.mark.parametrize("header, size", [
+    ("bytes=10-", 10),  # Start at EOF
+    ("bytes=15-20", 10),  # Start past EOF
+    ("bytes=-0", 10),  # Empty suffix
+    ("bytes=0-", 0),  # Empty file
+    ("bytes=-5", 0),  # Suffix of an empty file
+])
+def test_unsatisfiable_range(header, size):
+    with pytest.raises(ValueError):
+        server.parse_range(header, size)
@@ -0,0 +1,61 @@
+import asyncio
+
+import pytest
+
+import server
+
+
+class FakeClient:
+    def __init__(self):
+        self.closed = False
+
+    async def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(server, "provider_clients", {})
+    monkeypatch.setattr(server, "client_leases", {})
+    monkeypatch.setattr(server, "retired_clients", {})
+    return server.provider_clients
+
+
+def test_key_change_waits_for_in_flight_requests(pool):
+    async def scenario():
+        client = pool[("openai", "old-key")] = FakeClient()
+        async with server.leased_client("openai", "old-key") as leased:
+            assert leased is client
+            await server.close_provider_clients("openai")
+            assert not client.closed
+            assert ("openai", "old-key") not in pool
+        assert client.closed
+        assert not server.retired_clients
+
+    asyncio.run(scenario())
+
+
+def test_idle_client_closes_immediately(pool):
+    async def scenario():
+        client = pool[("anthropic", "key")] = FakeClient()
+        await server.close_provider_clients("anthropic")
+        assert client.closed
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.skipif(server.genai is None, reason="google-generativeai not installed")
+def test_gemini_reuses_one_client_per_key(pool, monkeypatch):
+    def no_configure(**kwargs):
+        raise AssertionError("genai.configure resets the SDK's global clients")
+
+    monkeypatch.setattr(server.genai, "configure", no_configure)
+
+    async def scenario():
+        first = server.get_provider_client("gemini", "key-a")
+        assert server.get_provider_client("gemini", "key-a") is first
+        assert server.get_provider_client("gemini", "key-b") is not first
+        assert server.gemini_model(first, "gemini-1.5-flash", "Be brief")._async_client is first
+        await server.close_provider_clients()
+
+    asyncio.run(scenario())
@@ -0,0 +1,59 @@
+import asyncio
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.skipif(server.np is None, reason="semantic cache needs numpy")
+
+
+def similarity(a: str, b: str) -> float:
+    return float(server.semantic_cache.embed(a) @ server.semantic_cache.embed(b))
+
+
+def test_swapped_conversion_is_not_a_hit():
+    score = similarity("convert int to str in python", "convert str to int in python")
+    assert score < server.SEMANTIC_CACHE_THRESHOLD
+
+
+def test_paraphrase_is_a_hit():
+    score = similarity("write a python fn to reverse a list", "python function reversing a list")
+    assert score >= server.SEMANTIC_CACHE_THRESHOLD
+
+
+def test_different_task_is_not_a_hit():
+    score = similarity("write a python function to reverse a list", "write a python function to sort a list")
+    assert score < server.SEMANTIC_CACHE_THRESHOLD
+
+
+def test_scope_includes_temperature():
+    history = [{"role": "user", "content": "hi"}]
+    assert server.semantic_scope(history, "q", "q", 100, 0.2) != server.semantic_scope(history, "q", "q", 100, 0.7)
+
+
+def test_summaries_do_not_leak_between_sessions(monkeypatch):
+    calls = []
+
+    async def fake_hedged_call(messages, model, provider, temperature=0.7, max_tokens=2000, hedge=None):
+        calls.append(messages[-1]["content"])
+        return f"summary {len(calls)}"
+
+    monkeypatch.setattr(server, "SEMANTIC_CACHE_ENABLED", True)
+    monkeypatch.setattr(server, "hedged_call", fake_hedged_call)
+    store = server.conversation_store
+    turns = server.SUMMARY_KEEP_RECENT_TURNS + 4
+    for session_id in ("leak-a", "leak-b"):
+        store.cache[session_id] = [
+            server.MessageRecord(store.next_id(), "user" if i % 2 == 0 else "assistant",
+                                 f"turn {i} about the parser", server.epoch_ms())
+            for i in range(turns)
+        ]
+    try:
+        asyncio.run(server.summarize_session("leak-a"))
+        asyncio.run(server.summarize_session("leak-b"))
+        assert len(calls) == 2
+        assert store.summaries["leak-a"]["summary"] != store.summaries["leak-b"]["summary"]
+    finally:
+        server.semantic_cache.clear()
+        for session_id in ("leak-a", "leak-b"):
+            store.evict(session_id)
@@ -0,0 +1,21 @@
+import server
+
+
+def test_truncated_utf8_at_end_of_file_is_latin1():
+    assert server.sniff_bytes(b"caf\xe9") == ("text", "latin-1")
+    assert server.sniff_bytes(b"caf\xc3", 4) == ("text", "latin-1")
+
+
+def test_character_cut_by_sample_is_still_utf8():
+    head = b"a" * (server.SNIFF_BYTES - 1) + b"\xc3"
+    assert server.sniff_bytes(head) == ("text", "utf-8")
+    assert server.sniff_bytes(head, server.SNIFF_BYTES + 1) == ("text", "utf-8")
+
+
+def test_short_file_is_readable_with_sniffed_encoding(tmp_path):
+    path = tmp_path / "menu.txt"
+    path.write_bytes(b"caf\xe9")
+    cache = server.SniffCache(8)
+    kind, encoding = cache.sniff(path)
+    assert kind == "text"
+    assert path.read_bytes().decode(encoding) == "café"
@@ -0,0 +1,31 @@
+import os
+import time
+import uuid
+
+import server
+
+
+def make_upload(directory, age_meta: float, age_part: float) -> str:
+    upload_id = uuid.uuid4().hex
+    meta_path, data_path = directory / f"{upload_id}.json", directory / f"{upload_id}.part"
+    meta_path.write_text("{}")
+    data_path.write_bytes(b"chunk")
+    now = time.time()
+    os.utime(meta_path, (now - age_meta, now - age_meta))
+    os.utime(data_path, (now - age_part, now - age_part))
+    return upload_id
+
+
+def test_sweep_uses_last_activity_and_skips_busy_uploads(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "UPLOAD_DIR", tmp_path)
+    ttl = server.UPLOAD_TTL
+    active = make_upload(tmp_path, age_meta=ttl * 2, age_part=1)
+    stale = make_upload(tmp_path, age_meta=ttl * 2, age_part=ttl * 2)
+    busy = make_upload(tmp_path, age_meta=ttl * 2, age_part=ttl * 2)
+    monkeypatch.setattr(server, "busy_uploads", {busy})
+
+    created = server.create_upload(server.UploadInit(path="big.bin", size=10))
+
+    remaining = {path.stem for path in tmp_path.glob("*.part")}
+    assert remaining == {active, busy, created["upload_id"]}
+    assert stale not in {path.stem for path in tmp_path.glob("*.json")}
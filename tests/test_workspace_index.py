@@ -0,0 +1,37 @@
+import threading
+
+import pytest
+from fastapi import HTTPException
+
+import server
+
+
+@pytest.mark.parametrize("project_root", ["/etc", "../..", "backend/../.."])
+def test_project_root_outside_workspace_is_rejected(project_root):
+    with pytest.raises(HTTPException) as error:
+        server.resolve_project_root(project_root)
+    assert error.value.status_code == 403
+
+
+def test_project_root_symlink_escape_is_rejected(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "escape").symlink_to("/etc")
+    with pytest.raises(HTTPException) as error:
+        server.resolve_project_root("escape")
+    assert error.value.status_code == 403
+
+
+def test_pack_serves_current_index_while_refresh_runs(tmp_path):
+    (tmp_path / "parser.py").write_text("def parse_tokens(source):\n    return source.split()\n")
+    index = server.WorkspaceIndex(tmp_path)
+    assert index.refresh()
+    index.refreshed = 0.0  # Stale: the next pack wants a rescan
+    with index.refresh_lock:  # Another thread is mid-rescan
+        done = threading.Event()
+        result = []
+        worker = threading.Thread(target=lambda: (result.append(index.pack("parse tokens", 500)), done.set()))
+        worker.start()
+        assert done.wait(2), "pack blocked behind the running refresh"
+        worker.join()
+    text, snippets = result[0]
+    assert [snippet["path"] for snippet in snippets] == ["parser.py"]